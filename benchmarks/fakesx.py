@@ -0,0 +1,661 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""A local, in-memory stand-in for an SX cluster.
+
+It implements the subset of the SX REST API used by sxshare: volume, node,
+user and cluster metadata queries, file listing, file metadata, block
+download and the upload protocol (initialize, add chunk, create blocks,
+flush), plus deletions and job polling. Authentication is not checked.
+
+Latency, block size and failures are configurable, both globally and per
+node. Every address in `nodes` must route to the listening socket, e.g.
+127.0.0.1, 127.0.0.2, ... on Linux.
+
+Run standalone with:
+
+    $ python -m benchmarks.fakesx --port 9000 --latency 0.005
+"""
+
+from __future__ import print_function
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urllib import unquote
+from urlparse import parse_qs, urlsplit
+
+
+SMALL_BLOCK_SIZE = 4 * 1024
+MEDIUM_BLOCK_SIZE = 16 * 1024
+LARGE_BLOCK_SIZE = 1024 * 1024
+HASH_LENGTH = 40
+
+# Node address used for anything the fake server creates by itself
+DEFAULT_NODE = '127.0.0.1'
+
+ADMIN_KEY = ('\0' * 42).encode('base64').strip()
+
+
+class NotFound(Exception):
+    pass
+
+
+class Failure(Exception):
+    pass
+
+
+class FakeFile(object):
+
+    def __init__(self, size, block_size, blocks, meta=None, created=None):
+        self.size = size
+        self.block_size = block_size
+        self.blocks = blocks
+        self.meta = meta or {}
+        self.created = int(created or time.time())
+        self.revision = '{}:{}'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S.000', time.gmtime(self.created)),
+            uuid.uuid4().hex)
+
+    def listing_entry(self):
+        return {
+            'fileSize': self.size,
+            'blockSize': self.block_size,
+            'createdAt': self.created,
+            'fileRevision': self.revision,
+        }
+
+
+class FakeVolume(object):
+
+    def __init__(self, name, size=1024 ** 4, replica_count=1, owner='admin',
+                 meta=None, custom_meta=None, max_revisions=1):
+        self.name = name
+        self.size = size
+        self.replica_count = replica_count
+        self.owner = owner
+        self.meta = meta or {}
+        self.custom_meta = custom_meta or {}
+        self.max_revisions = max_revisions
+        self.files = {}
+
+    @property
+    def used_size(self):
+        return sum(f.size for f in self.files.itervalues())
+
+    def as_dict(self, include_meta=False, include_custom_meta=False):
+        data = {
+            'owner': self.owner,
+            'replicaCount': self.replica_count,
+            'maxRevisions': self.max_revisions,
+            'privs': 'rw',
+            'sizeBytes': self.size,
+            'usedSize': self.used_size,
+        }
+        if include_meta:
+            data['volumeMeta'] = self.meta
+        if include_custom_meta:
+            data['customVolumeMeta'] = self.custom_meta
+        return data
+
+    def list(self, pattern='', recursive=False, limit=None, after=None):
+        """Mimic SX listing semantics.
+
+        An empty pattern, or one ending with a slash, lists a directory.
+        Directories are returned with a trailing slash, unless recursive.
+        """
+        pattern = pattern.lstrip('/')
+        if pattern and not pattern.endswith('/') and \
+                not any(c in pattern for c in '*?['):
+            # An exact name: a file, a directory, or both
+            entries = {}
+            if pattern in self.files:
+                entries['/' + pattern] = self.files[pattern]
+            prefix = pattern + '/'
+            if any(p.startswith(prefix) for p in self.files):
+                if recursive:
+                    entries.update(('/' + p, f)
+                                   for p, f in self.files.iteritems()
+                                   if p.startswith(prefix))
+                else:
+                    entries['/' + prefix] = None
+            return self._page(entries, limit, after)
+
+        if pattern.endswith('/') or not pattern:
+            directory, name_pattern = pattern, '*'
+        else:
+            directory, _, name_pattern = pattern.rpartition('/')
+            if directory:
+                directory += '/'
+        # Wildcards can be escaped with a backslash
+        directory = re.sub(r'\\(.)', r'\1', directory)
+        name_pattern = re.sub(r'\\(.)', r'[\1]', name_pattern)
+
+        entries = {}
+        for path, f in self.files.iteritems():
+            if not path.startswith(directory):
+                continue
+            rest = path[len(directory):]
+            if recursive:
+                if fnmatch.fnmatchcase(rest, name_pattern):
+                    entries['/' + path] = f
+                continue
+            name, slash, _ = rest.partition('/')
+            if not fnmatch.fnmatchcase(name, name_pattern):
+                continue
+            if slash:
+                entries['/' + directory + name + '/'] = None
+            else:
+                entries['/' + path] = f
+        return self._page(entries, limit, after)
+
+    def _page(self, entries, limit, after):
+        names = sorted(entries)
+        if after is not None:
+            after = '/' + after.lstrip('/')
+            names = [n for n in names if n > after]
+        if limit is not None:
+            names = names[:int(limit)]
+        return {
+            name: entries[name].listing_entry()
+            if entries[name] is not None else {}
+            for name in names}
+
+
+class FakeCluster(object):
+    """State of the fake cluster, independent of HTTP."""
+
+    def __init__(self, nodes=(DEFAULT_NODE,), block_size=None,
+                 cluster_meta=None):
+        self.uuid = str(uuid.uuid4())
+        self.nodes = list(nodes)
+        self.block_size = block_size
+        self.meta = cluster_meta or {}
+        self.volumes = {}
+        self.blocks = {}
+        self.uploads = {}
+        self.lock = threading.RLock()
+        self.users = {
+            'admin': {'admin': True, 'userDesc': '', 'userQuota': 0,
+                      'userQuotaUsed': 0},
+        }
+
+    def get_block_size(self, size):
+        if self.block_size:
+            return self.block_size
+        if size < 128 * 1024:
+            return SMALL_BLOCK_SIZE
+        elif size < 256 * 1024 * 1024:
+            return MEDIUM_BLOCK_SIZE
+        return LARGE_BLOCK_SIZE
+
+    def hash_block(self, content):
+        return hashlib.sha1(self.uuid + content).hexdigest()
+
+    def get_volume(self, name):
+        try:
+            return self.volumes[name]
+        except KeyError:
+            raise NotFound("No such volume: {}".format(name))
+
+    def create_volume(self, name, **kwargs):
+        with self.lock:
+            kwargs.setdefault('replica_count', len(self.nodes))
+            volume = FakeVolume(name, **kwargs)
+            self.volumes[name] = volume
+            return volume
+
+    def get_file(self, volume, path):
+        try:
+            return self.get_volume(volume).files[path]
+        except KeyError:
+            raise NotFound("No such file: {}".format(path))
+
+    def put_file(self, volume, path, content, meta=None, created=None):
+        """Store a file directly, bypassing the upload protocol."""
+        block_size = self.get_block_size(len(content))
+        hashes = []
+        with self.lock:
+            for offset in xrange(0, len(content), block_size):
+                block = content[offset:offset + block_size]
+                block += '\0' * (block_size - len(block))
+                block_hash = self.hash_block(block)
+                self.blocks[block_hash] = block
+                hashes.append(block_hash)
+            f = FakeFile(len(content), block_size, hashes, meta, created)
+            self.get_volume(volume).files[path.lstrip('/')] = f
+            return f
+
+    def delete_file(self, volume, path):
+        with self.lock:
+            try:
+                del self.get_volume(volume).files[path]
+            except KeyError:
+                raise NotFound("No such file: {}".format(path))
+
+    def block_nodes(self, block_hash, replica_count):
+        """Deterministically place replicas of a block."""
+        count = max(1, min(replica_count, len(self.nodes)))
+        start = int(block_hash[:8], 16) % len(self.nodes)
+        return [self.nodes[(start + i) % len(self.nodes)]
+                for i in xrange(count)]
+
+    def file_data(self, volume, path):
+        v = self.get_volume(volume)
+        f = self.get_file(volume, path)
+        return {
+            'blockSize': f.block_size,
+            'fileSize': f.size,
+            'createdAt': f.created,
+            'fileRevision': f.revision,
+            'fileData': [{h: self.block_nodes(h, v.replica_count)}
+                         for h in f.blocks],
+        }
+
+    def get_blocks(self, block_size, hashes):
+        content = []
+        for h in hashes:
+            try:
+                block = self.blocks[h]
+            except KeyError:
+                raise NotFound("No such block: {}".format(h))
+            if len(block) != block_size:
+                raise NotFound("Invalid block size")
+            content.append(block)
+        return ''.join(content)
+
+    def initialize_upload(self, volume, path, size, hashes, meta):
+        v = self.get_volume(volume)
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[token] = {
+                'volume': volume,
+                'path': path,
+                'size': size,
+                'hashes': list(hashes),
+                'meta': meta or {},
+                'block_size': self.get_block_size(size),
+            }
+        return token, self._upload_data(hashes, v)
+
+    def add_chunk(self, token, hashes, meta):
+        upload = self.uploads[token]
+        with self.lock:
+            upload['hashes'].extend(hashes)
+            upload['meta'].update(meta or {})
+        v = self.get_volume(upload['volume'])
+        return self._upload_data(hashes, v)
+
+    def _upload_data(self, hashes, volume):
+        return {h: self.block_nodes(h, volume.replica_count)
+                for h in hashes if h not in self.blocks}
+
+    def create_blocks(self, token, block_size, content):
+        if token not in self.uploads:
+            raise NotFound("No such upload token")
+        with self.lock:
+            for offset in xrange(0, len(content), block_size):
+                block = content[offset:offset + block_size]
+                self.blocks[self.hash_block(block)] = block
+
+    def flush(self, token):
+        with self.lock:
+            upload = self.uploads.pop(token)
+            missing = [h for h in upload['hashes'] if h not in self.blocks]
+            if missing:
+                raise Failure("Missing blocks: {}".format(len(missing)))
+            f = FakeFile(upload['size'], upload['block_size'],
+                         upload['hashes'], upload['meta'])
+            self.get_volume(upload['volume']).files[upload['path']] = f
+
+
+class FakeSXServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server exposing a FakeCluster.
+
+    Options:
+      - latency -- seconds added to every request
+      - block_latency -- seconds added per block in block downloads
+      - node_latency -- {node address: extra seconds}
+      - failure_rate -- probability of answering a request with HTTP 500
+      - fail_operations -- if given, only these operations may fail
+        (see `SXRequestHandler.route` for operation names)
+      - failed_nodes -- node addresses which always answer with HTTP 500
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('', 0), cluster=None, latency=0,
+                 block_latency=0, node_latency=None, failure_rate=0,
+                 fail_operations=None, failed_nodes=None):
+        HTTPServer.__init__(self, address, SXRequestHandler)
+        self.cluster = cluster or FakeCluster()
+        self.latency = latency
+        self.block_latency = block_latency
+        self.node_latency = node_latency or {}
+        self.failure_rate = failure_rate
+        self.fail_operations = fail_operations
+        self.failed_nodes = set(failed_nodes or ())
+        self.request_counts = {}
+        self._jobs = {}
+        self._counter_lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, operation):
+        with self._counter_lock:
+            self.request_counts[operation] = \
+                self.request_counts.get(operation, 0) + 1
+
+    def start(self):
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='fakesx')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class SXRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeSX/1.0'
+    # Headers and body are written separately; without this, delayed ACKs
+    # add ~40ms to every keep-alive request.
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def cluster(self):
+        return self.server.cluster
+
+    @property
+    def node(self):
+        return self.connection.getsockname()[0]
+
+    def do_HEAD(self):
+        self.handle_request()
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_PUT(self):
+        self.handle_request()
+
+    def do_DELETE(self):
+        self.handle_request()
+
+    def handle_request(self):
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query, keep_blank_values=True)
+        self.path_items = [unquote(p) for p in url.path.split('/')[1:]]
+        if self.path_items == ['']:
+            self.path_items = []
+        # Like SX, treat repeated slashes in file paths as one
+        self.path_items[1:] = [p for p in self.path_items[1:] if p]
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else ''
+
+        try:
+            operation, handler = self.route()
+        except NotFound as e:
+            return self.send_json({'ErrorMessage': str(e)}, status=404)
+        self.server.count(operation)
+
+        delay = self.server.latency + self.server.node_latency.get(
+            self.node, 0)
+        if delay:
+            time.sleep(delay)
+        if self.should_fail(operation):
+            return self.send_json(
+                {'ErrorMessage': 'Injected failure'}, status=500)
+        try:
+            handler()
+        except NotFound as e:
+            self.send_json({'ErrorMessage': str(e)}, status=404)
+        except (Failure, KeyError, ValueError) as e:
+            self.send_json({'ErrorMessage': str(e)}, status=400)
+
+    def should_fail(self, operation):
+        if self.node in self.server.failed_nodes:
+            return True
+        if not self.server.failure_rate:
+            return False
+        allowed = self.server.fail_operations
+        if allowed is not None and operation not in allowed:
+            return False
+        return random.random() < self.server.failure_rate
+
+    def route(self):
+        """Return (operation name, handler) for the current request."""
+        items, q, method = self.path_items, self.query, self.command
+        if method == 'HEAD':
+            return 'head', self.head_cluster
+        if not items:
+            if 'volumeList' in q:
+                return 'listVolumes', self.list_volumes
+            if 'nodeList' in q:
+                return 'listNodes', self.list_nodes
+            if 'clusterMeta' in q:
+                return 'getClusterMetadata', self.cluster_meta
+            raise NotFound("Unknown query")
+        first = items[0]
+        if first == '.users':
+            return 'listUsers', self.list_users
+        if first == '.results':
+            return 'jobPoll', self.job_poll
+        if first == '.data':
+            if method == 'GET':
+                return 'getBlocks', self.get_blocks
+            return 'createBlocks', self.create_blocks
+        if first == '.upload':
+            if self.body:
+                return 'initializeAddChunk', self.add_chunk
+            return 'flushUploadedFile', self.flush
+        if len(items) == 1:
+            o = q.get('o', [None])[0]
+            if method == 'GET' and o == 'locate':
+                return 'locateVolume', self.locate_volume
+            if method == 'GET' and o == 'list':
+                return 'listFiles', self.list_files
+            if method == 'PUT' and o == 'mod':
+                return 'modifyVolume', self.modify_volume
+            if method == 'PUT':
+                return 'createVolume', self.create_volume
+            raise NotFound("Unknown volume query")
+        if method == 'GET' and 'fileMeta' in q:
+            return 'getFileMeta', self.file_meta
+        if method == 'GET':
+            return 'getFile', self.get_file
+        if method == 'PUT':
+            return 'initializeFile', self.initialize_file
+        if method == 'DELETE':
+            return 'deleteFile', self.delete_file
+        raise NotFound("Unknown query")
+
+    # Responses
+
+    def send_headers(self, status, content_type, length):
+        self.send_response(status)
+        self.send_header('SX-Cluster', '2.1 ({})'.format(self.cluster.uuid))
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data)
+        self.send_headers(status, 'application/json', len(body))
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_binary(self, content):
+        self.send_headers(200, 'application/octet-stream', len(content))
+        self.wfile.write(content)
+
+    def send_job(self):
+        job_id = uuid.uuid4().hex
+        self.server._jobs[job_id] = 'OK'
+        self.send_json({'requestId': job_id, 'minPollInterval': 1,
+                        'maxPollInterval': 10})
+
+    # Handlers
+
+    def head_cluster(self):
+        self.send_json({})
+
+    def list_volumes(self):
+        self.send_json({'volumeList': {
+            name: v.as_dict('volumeMeta' in self.query,
+                            'customVolumeMeta' in self.query)
+            for name, v in self.cluster.volumes.items()}})
+
+    def list_nodes(self):
+        self.send_json({'nodeList': self.cluster.nodes})
+
+    def cluster_meta(self):
+        self.send_json({'clusterMeta': self.cluster.meta})
+
+    def list_users(self):
+        self.send_json(self.cluster.users)
+
+    def job_poll(self):
+        status = self.server._jobs.pop(self.path_items[1], 'OK')
+        self.send_json({'requestId': self.path_items[1],
+                        'requestStatus': status, 'requestMessage': ''})
+
+    def locate_volume(self):
+        volume = self.cluster.get_volume(self.path_items[0])
+        data = {'nodeList': self.cluster.nodes}
+        if 'size' in self.query:
+            data['blockSize'] = self.cluster.get_block_size(
+                int(self.query['size'][0]))
+        if 'volumeMeta' in self.query:
+            data['volumeMeta'] = volume.meta
+        if 'customVolumeMeta' in self.query:
+            data['customVolumeMeta'] = volume.custom_meta
+        self.send_json(data)
+
+    def list_files(self):
+        def get(key):
+            return self.query.get(key, [None])[0]
+
+        volume = self.cluster.get_volume(self.path_items[0])
+        files = volume.list(get('filter') or '',
+                            recursive='recursive' in self.query,
+                            limit=get('limit'), after=get('after'))
+        self.send_json({
+            'volumeSize': volume.size,
+            'replicaCount': volume.replica_count,
+            'fileList': files,
+        })
+
+    def create_volume(self):
+        body = json.loads(self.body)
+        self.cluster.create_volume(
+            self.path_items[0], size=body['volumeSize'],
+            owner=body['owner'], replica_count=body['replicaCount'],
+            max_revisions=body.get('maxRevisions', 1),
+            meta=body.get('volumeMeta'))
+        self.send_job()
+
+    def modify_volume(self):
+        volume = self.cluster.get_volume(self.path_items[0])
+        body = json.loads(self.body)
+        if 'customVolumeMeta' in body:
+            volume.custom_meta = body['customVolumeMeta']
+        self.send_job()
+
+    def file_meta(self):
+        volume, path = self.path_items[0], '/'.join(self.path_items[1:])
+        f = self.cluster.get_file(volume, path)
+        self.send_json({'fileMeta': f.meta})
+
+    def get_file(self):
+        volume, path = self.path_items[0], '/'.join(self.path_items[1:])
+        self.send_json(self.cluster.file_data(volume, path))
+
+    def delete_file(self):
+        volume, path = self.path_items[0], '/'.join(self.path_items[1:])
+        self.cluster.delete_file(volume, path)
+        self.send_job()
+
+    def get_blocks(self):
+        block_size = int(self.path_items[1])
+        names = self.path_items[2]
+        hashes = [names[i:i + HASH_LENGTH]
+                  for i in xrange(0, len(names), HASH_LENGTH)]
+        if self.server.block_latency:
+            time.sleep(self.server.block_latency * len(hashes))
+        self.send_binary(self.cluster.get_blocks(block_size, hashes))
+
+    def create_blocks(self):
+        block_size, token = int(self.path_items[1]), self.path_items[2]
+        self.cluster.create_blocks(token, block_size, self.body)
+        self.send_json({})
+
+    def initialize_file(self):
+        volume, path = self.path_items[0], '/'.join(self.path_items[1:])
+        body = json.loads(self.body)
+        token, upload_data = self.cluster.initialize_upload(
+            volume, path, body['fileSize'], body['fileData'],
+            body.get('fileMeta'))
+        self.send_json({'uploadToken': token, 'uploadData': upload_data})
+
+    def add_chunk(self):
+        body = json.loads(self.body)
+        upload_data = self.cluster.add_chunk(
+            self.path_items[1], body['fileData'], body.get('fileMeta'))
+        self.send_json({'uploadData': upload_data})
+
+    def flush(self):
+        self.cluster.flush(self.path_items[1])
+        self.send_job()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake SX cluster.")
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--nodes', nargs='+', default=[DEFAULT_NODE])
+    parser.add_argument('--block-size', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--block-latency', type=float, default=0)
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--fail-operations', nargs='+', default=None)
+    parser.add_argument('--failed-nodes', nargs='+', default=None)
+    parser.add_argument('--sxshare-address', default=None,
+                        help="Set `sxshare_address` in the cluster meta.")
+    args = parser.parse_args()
+
+    cluster = FakeCluster(nodes=args.nodes, block_size=args.block_size)
+    if args.sxshare_address:
+        cluster.meta['sxshare_address'] = args.sxshare_address.encode('hex')
+    server = FakeSXServer(
+        (args.host, args.port), cluster, latency=args.latency,
+        block_latency=args.block_latency, failure_rate=args.failure_rate,
+        fail_operations=args.fail_operations, failed_nodes=args.failed_nodes)
+    print("Fake SX cluster {} listening on port {}".format(
+        cluster.uuid, server.port))
+    print("Admin key: {}".format(ADMIN_KEY))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
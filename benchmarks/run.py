@@ -0,0 +1,295 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Benchmarks for sxshare, run against a local fake SX cluster.
+
+Each scenario drives the real views and management commands through the
+Django test client, so the numbers include sxshare's own overhead plus the
+simulated cluster latency. Results are printed (or saved) as JSON, to be
+compared between revisions:
+
+    $ python -m benchmarks.run --output before.json
+    $ python -m benchmarks.run --latency 0.002 --scenarios download_throughput
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import yaml
+
+from benchmarks.fakesx import ADMIN_KEY, FakeCluster, FakeSXServer
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VOLUME = 'bench'
+BROWSER_UA = 'Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/45.0'
+HEADLESS_UA = 'Wget/1.17.1 (linux-gnu)'
+
+
+def summarize(durations, **extra):
+    durations = sorted(durations)
+    count = len(durations)
+
+    def percentile(p):
+        return durations[min(count - 1, int(round(p * (count - 1))))]
+
+    result = {
+        'iterations': count,
+        'total': sum(durations),
+        'mean': sum(durations) / count,
+        'min': durations[0],
+        'p50': percentile(.5),
+        'p95': percentile(.95),
+        'p99': percentile(.99),
+        'max': durations[-1],
+    }
+    result.update(extra)
+    return result
+
+
+def timed(func, iterations):
+    durations = []
+    for _ in xrange(iterations):
+        start = time.time()
+        func()
+        durations.append(time.time() - start)
+    return durations
+
+
+class Benchmark(object):
+    """Seeds the fake cluster and runs the scenarios."""
+    scenarios = [
+        'share_creation',
+        'token_resolution',
+        'directory_listing',
+        'download_throughput',
+        'delete_expired_links',
+        'send_notifications',
+    ]
+
+    def __init__(self, server, args):
+        self.server = server
+        self.cluster = server.cluster
+        self.args = args
+
+    def setup(self):
+        from django.conf import settings
+        from django.test import Client
+
+        settings.EMAIL_BACKEND = \
+            'django.core.mail.backends.locmem.EmailBackend'
+        self.client = Client()
+
+        self.cluster.create_volume(VOLUME)
+        self.cluster.put_file(VOLUME, 'small.txt', 'x' * 1024)
+        self.cluster.put_file(
+            VOLUME, 'large.bin',
+            os.urandom(1024 * 1024) * self.args.file_size)
+        for i in xrange(self.args.dir_size):
+            self.cluster.put_file(
+                VOLUME, 'bigdir/file-{:06d}.txt'.format(i), 'content')
+
+        from sxshare import core
+        core.warmup()
+        self.core = core
+
+    def share(self, path, **kwargs):
+        token = self.core.share_file('{}/{}'.format(VOLUME, path), **kwargs)
+        return '/.sxshare/{}'.format(token)
+
+    def get(self, url, user_agent=BROWSER_UA, **kwargs):
+        response = self.client.get(url, HTTP_USER_AGENT=user_agent, **kwargs)
+        assert response.status_code == 200, response.status_code
+        return response
+
+    def run(self, names):
+        results = {}
+        for name in names:
+            self.server.request_counts.clear()
+            start = time.time()
+            results[name] = getattr(self, name)()
+            results[name]['wall_time'] = time.time() - start
+            results[name]['sx_requests'] = dict(self.server.request_counts)
+        return results
+
+    # Scenarios
+
+    def share_creation(self):
+        data = json.dumps({
+            'path': '{}/small.txt'.format(VOLUME),
+            'access_key': ADMIN_KEY,
+            'expire_time': 3600,
+        })
+
+        def create():
+            response = self.client.post('/.sxshare/api/share', data,
+                                        content_type='application/json')
+            assert json.loads(response.content)['status'], response.content
+        return summarize(timed(create, self.args.iterations))
+
+    def token_resolution(self):
+        url = self.share('small.txt')
+        return summarize(timed(lambda: self.get(url), self.args.iterations))
+
+    def directory_listing(self):
+        url = self.share('bigdir/')
+        last_page = (self.args.dir_size + 19) // 20
+        first = timed(lambda: self.get(url + '/'), self.args.iterations)
+        last = timed(lambda: self.get(url + '/?page={}'.format(last_page)),
+                     self.args.iterations)
+        return summarize(first + last, entries=self.args.dir_size,
+                         first_page=summarize(first),
+                         last_page=summarize(last))
+
+    def download_throughput(self):
+        url = self.share('large.bin')
+        size = self.args.file_size * 1024 * 1024
+
+        def download():
+            response = self.get(url, user_agent=HEADLESS_UA)
+            received = sum(len(chunk) for chunk in response.streaming_content)
+            response.close()
+            assert received == size, received
+        durations = timed(download, max(1, self.args.iterations // 10))
+        return summarize(durations, bytes=size,
+                         mb_per_second=[size / d / 2 ** 20 for d in durations])
+
+    def delete_expired_links(self):
+        from django.core.management import call_command
+        self.seed_links(self.args.links)
+        durations = timed(lambda: call_command('delete_expired_links',
+                                               stdout=open(os.devnull, 'w')),
+                          1)
+        return summarize(durations, links=self.args.links)
+
+    def send_notifications(self):
+        from django.core import mail
+        from django.core.management import call_command
+        url = self.share('small.txt', email='owner@example.com')
+        token = url.split('/.sxshare/', 1)[1]
+        now = int(time.time())
+        for i in xrange(self.args.links):
+            marker = json.dumps({'token': token, 'path': '',
+                                 'ip': '10.0.0.{}'.format(i % 250),
+                                 'user_agent': BROWSER_UA})
+            self.cluster.put_file(
+                self.core.share_links_volname,
+                'notify/owner@example.com.{}.{:08d}'.format(now, i), marker)
+        durations = timed(lambda: call_command('send_notifications'), 1)
+        return summarize(durations, markers=self.args.links,
+                         emails=len(mail.outbox))
+
+    def seed_links(self, count):
+        now = int(time.time())
+        for i in xrange(count):
+            data = {'filename': 'small.txt',
+                    'path': '{}/small.txt'.format(VOLUME)}
+            if i % 2:
+                data['expires_on'] = now - 60
+            self.cluster.put_file(
+                self.core.share_links_volname,
+                'seed{:08d}/small.txt'.format(i), json.dumps(data))
+
+
+def write_conf(path, server, nodes, state_dir):
+    conf = {
+        'server': {'debug': True, 'hosts': ['testserver']},
+        'app': {'state_dir': state_dir},
+        'mailing': {
+            'host': 'localhost',
+            'from': 'sxshare@example.com',
+            'notifications': {'email_subject': "Downloads"},
+        },
+        'sx': {
+            'cluster': 'localhost',
+            'ip_addresses': nodes,
+            'is_secure': False,
+            'port': server.port,
+            'admin_key': ADMIN_KEY,
+        },
+    }
+    with open(path, 'w') as f:
+        yaml.safe_dump(conf, f, default_flow_style=False)
+    os.chmod(path, 0o600)
+
+
+def get_git_hash():
+    from sxshare import get_git_hash
+    return get_git_hash()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help="Save results to this file.")
+    parser.add_argument('--scenarios', nargs='+', choices=Benchmark.scenarios,
+                        default=Benchmark.scenarios)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--dir-size', type=int, default=2000,
+                        help="Number of files in the listed directory.")
+    parser.add_argument('--file-size', type=int, default=32,
+                        help="Size of the downloaded file, in MB.")
+    parser.add_argument('--links', type=int, default=200,
+                        help="Links/markers processed by the commands.")
+    parser.add_argument('--nodes', nargs='+', default=['127.0.0.1'])
+    parser.add_argument('--block-size', type=int, default=None)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--block-latency', type=float, default=0)
+    parser.add_argument('--failure-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    cluster = FakeCluster(nodes=args.nodes, block_size=args.block_size)
+    cluster.meta['sxshare_address'] = \
+        'http://testserver/.sxshare/'.encode('hex')
+    server = FakeSXServer(
+        ('', 0), cluster, latency=args.latency,
+        block_latency=args.block_latency, failure_rate=args.failure_rate)
+    server.start()
+
+    tmp_dir = tempfile.mkdtemp(prefix='sxshare-bench-')
+    try:
+        conf_path = os.path.join(tmp_dir, 'conf.yaml')
+        write_conf(conf_path, server, args.nodes,
+                   os.path.join(tmp_dir, 'state'))
+        os.environ['SXSHARE_CONF'] = conf_path
+        os.environ['DJANGO_SETTINGS_MODULE'] = 'sxshare.settings'
+        sys.path.insert(0, ROOT_DIR)
+        os.chdir(tmp_dir)  # Keep the debug log out of the tree
+
+        import django
+        django.setup()
+
+        benchmark = Benchmark(server, args)
+        benchmark.setup()
+        results = benchmark.run(args.scenarios)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    os.chdir(ROOT_DIR)
+    output = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'git_hash': get_git_hash(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'results': results,
+    }
+    output = json.dumps(output, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -935,6 +935,32 @@ if (!FileOperations) {
                 $(lb).fadeIn();
                 $(pnb).fadeIn();
 
+            } else if(file_type === 'archive') {
+
+                $.ajax({
+                    url : file_url + '?preview',
+                    success: function(data, status, xhr) {
+                        $(lb).html(data).css({
+                            'background': '#fff',
+                            'overflow' : 'auto',
+                            'text-align' : 'left',
+                            'vertical-align' : 'top'
+                        }).fadeIn();
+
+                        $(pnb).fadeIn();
+                    },
+                    error : function (xhr, status) {
+                        var dlg = FileOperations.getDialog(Skylable_Lang['previewErrorTitle']);
+                        dlg.html('<p>'+Skylable_Lang['previewLoadFailed']+'</p>');
+                        dlg.dialog('option', 'buttons', [{
+                            text: Skylable_Lang['closeBtn'],
+                            click:function(e) {
+                                dlg.dialog('close');
+                            }
+                        }]);
+                        dlg.dialog('open');
+                    }
+                });
             } else if(file_type === 'source' || file_type === 'text') {
 
                 $.ajax({
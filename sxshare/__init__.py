@@ -2,6 +2,7 @@
 # License: MIT, see LICENSE for more details.
 
 import logging
+import os
 import subprocess
 
 logger = logging.getLogger('sxshare')
@@ -10,17 +11,29 @@ VERSION = (1, 0, 3, 'dev')
 
 
 def get_version():
-    version = '.'.join(str(n) for n in VERSION)
-    git_hash = get_git_hash()
-    if git_hash is not None:
-        version = '{} (@{})'.format(version, git_hash)
-    return version
+    """Return the version, with the git hash if running from a checkout.
+
+    Computed once per process.
+    """
+    global _version
+    if _version is None:
+        version = '.'.join(str(n) for n in VERSION)
+        git_hash = get_git_hash()
+        if git_hash is not None:
+            version = '{} (@{})'.format(version, git_hash)
+        _version = version
+    return _version
+
+
+_version = None
 
 
 def get_git_hash():
     try:
-        return subprocess.check_output([
-            'git', 'rev-parse', '--short', 'HEAD',
-        ]).strip()
-    except subprocess.CalledProcessError:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output([
+                'git', 'rev-parse', '--short', 'HEAD',
+            ], cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=devnull).strip()
+    except (subprocess.CalledProcessError, OSError):
         return None
@@ -0,0 +1,169 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Load shedding which adapts to the latency of the cluster.
+
+With `settings.ADMISSION_ENABLED`, every worker process serves at most
+`limit` requests at once (streamed responses count until they're sent), and
+answers the others right away with 503 and Retry-After, instead of letting
+them pile up behind a slow cluster until they all time out.
+
+The limit adapts like TCP's congestion window (AIMD): it grows by one for
+every `limit` SX requests answered in time, and is cut by
+`DECREASE_FACTOR` when a request fails or takes longer than
+`settings.ADMISSION_TOLERANCE` times the usual duration of its operation
+(a slow moving average), at most once per `DECREASE_INTERVAL`. Only
+transport errors and server errors are failures: 404 and other client
+errors are answers, e.g. to the many lookups of files which may not exist.
+Block fetches take as long as their batches are big, so only their
+failures count.
+
+Bulk requests (downloads streamed by the workers, searches and uploads, see
+`admit_bulk`) may only fill `settings.ADMISSION_BULK_SHARE` of the limit,
+so that pages, HEAD and conditional requests are still served when they
+are shed.
+"""
+
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from sxshare import metrics
+
+
+DECREASE_FACTOR = 0.8
+# Seconds between decreases, so that a burst of slow requests counts once
+DECREASE_INTERVAL = 1
+# Weight of a new duration in the moving averages
+SMOOTHING = 0.05
+# Requests faster than this are never slow
+MIN_SLOW_DURATION = 0.1
+# Operations whose duration depends on the size of the request
+SIZED_OPERATIONS = {'getBlocks', 'createBlocks'}
+# Views which are never shed
+EXEMPT_VIEWS = {'HealthView', 'ReadyView', 'MetricsView'}
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed."""
+
+    def __init__(self, priority):
+        super(Overloaded, self).__init__(
+            "Too many requests in progress ({})".format(priority))
+        self.priority = priority
+        self.retry_after = settings.ADMISSION_RETRY_AFTER
+
+
+class Limiter(object):
+    """Requests in progress in this process, and their adaptive limit."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limit = float(settings.ADMISSION_INITIAL_LIMIT)
+        self.in_flight = 0
+        self.durations = {}  # operation: moving average
+        self.decreased = 0
+
+    def acquire(self):
+        """Admit a request, or raise Overloaded."""
+        with self.lock:
+            if self.in_flight >= int(self.limit):
+                raise Overloaded('interactive')
+            self.in_flight += 1
+        metrics.admission_in_flight.inc()
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        metrics.admission_in_flight.dec()
+
+    def check_bulk(self):
+        """Raise Overloaded if an admitted request can't go on as a bulk
+        one."""
+        with self.lock:
+            share = max(1, int(self.limit * settings.ADMISSION_BULK_SHARE))
+            if self.in_flight > share:
+                raise Overloaded('bulk')
+
+    def record(self, operation, duration, ok):
+        """Adapt the limit to an SX request, answered by the cluster (`ok`)
+        or failed."""
+        if ok and operation in SIZED_OPERATIONS:
+            return
+        with self.lock:
+            slow = not ok
+            if ok:
+                average = self.durations.get(operation, duration)
+                slow = duration > max(
+                    MIN_SLOW_DURATION,
+                    average * settings.ADMISSION_TOLERANCE)
+                # Slow requests move the average less, but do move it, so
+                # that the limit recovers if the cluster stays slower
+                weight = SMOOTHING / 10 if slow else SMOOTHING
+                self.durations[operation] = \
+                    average + weight * (duration - average)
+            if slow:
+                now = time.time()
+                if now - self.decreased < DECREASE_INTERVAL:
+                    return
+                self.decreased = now
+                self.limit = max(settings.ADMISSION_MIN_LIMIT,
+                                 self.limit * DECREASE_FACTOR)
+            else:
+                self.limit = min(settings.ADMISSION_MAX_LIMIT,
+                                 self.limit + 1 / self.limit)
+            limit = self.limit
+        metrics.admission_limit.set(int(limit))
+
+
+limiter = Limiter()
+
+
+def record(operation, duration, ok):
+    """Adapt the limit to an SX request, see `api.instrument`."""
+    if settings.ADMISSION_ENABLED:
+        limiter.record(operation, duration, ok)
+
+
+def admit_bulk(request):
+    """Raise Overloaded if the request (a bulk one) should be shed."""
+    if getattr(request, '_admitted', False):
+        limiter.check_bulk()
+
+
+class ReleasingStream(object):
+    """Response iterator which releases the place of its request once
+    exhausted or closed (even if it was never iterated)."""
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.released = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.iterator:
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.released:
+            self.released = True
+            limiter.release()
+        close = getattr(self.iterator, 'close', None)
+        if close is not None:
+            close()
+
+
+def overloaded_response(error):
+    """Service Unavailable, with the time to retry after."""
+    metrics.shed_requests.inc(priority=error.priority)
+    response = HttpResponse(
+        "The service is busy, please try again later.",
+        content_type='text/plain', status=503)
+    response['Retry-After'] = error.retry_after
+    return response
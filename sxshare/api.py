@@ -3,19 +3,73 @@
 
 from __future__ import unicode_literals
 
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import requests
 from django.conf import settings
 from django.core.checks import Critical, register
 
 from sxclient import Cluster, UserData, SXController, SXFileCat, SXFileUploader
-from sxclient.exceptions import SXClientException
+from sxclient.exceptions import (
+    SXClientException, SXClusterClientError, SXClusterNotFound,
+    SXClusterRequestTimeout)
+
+from . import admission, logger, metrics, tracing
+
+
+DEFAULT_CLUSTER = 'default'
+
+_local = threading.local()
+
+
+def get_clusters():
+    """Return the names of the configured clusters, the default (the `sx`
+    section of the config) first."""
+    return [DEFAULT_CLUSTER] + sorted(settings.SX_CLUSTERS)
+
+
+def _get_conf(name):
+    if name == DEFAULT_CLUSTER:
+        return settings.SX_CONF
+    try:
+        return settings.SX_CLUSTERS[name]
+    except KeyError:
+        raise ValueError("Unknown cluster: {}".format(name))
+
+
+def current_cluster():
+    """Return the name of the cluster used by this thread."""
+    return getattr(_local, 'cluster', DEFAULT_CLUSTER)
 
-from . import logger
 
+def activate(name):
+    """Use the given cluster in this thread, e.g. for the current
+    request."""
+    _get_conf(name)
+    _local.cluster = name
 
-conf = settings.SX_CONF
 
+@contextmanager
+def use_cluster(name):
+    """Use the given cluster in this thread within the block."""
+    previous = current_cluster()
+    activate(name)
+    try:
+        yield
+    finally:
+        activate(previous)
+
+
+def get_cluster_for_host(host):
+    """Return the name of the cluster served at the given hostname (the
+    default one, unless it's listed in the `hosts` of a cluster)."""
+    return _get_hosts().get(host.lower(), DEFAULT_CLUSTER)
 
-def _get_user_data():
+
+def _get_user_data(conf):
     if 'admin_key' in conf:
         return UserData.from_key(conf['admin_key'])
     elif 'admin_key_path' in conf:
@@ -26,7 +80,7 @@ def _get_user_data():
             "in the sx config.")
 
 
-def _get_cluster():
+def _get_cluster(conf):
     ip_addresses = conf.get('ip_addresses')
     if isinstance(ip_addresses, basestring):
         ip_addresses = [ip_addresses]
@@ -40,25 +94,183 @@ def _get_cluster():
     }
     return Cluster(**kwargs)
 
-cluster = _get_cluster()
-user_data = _get_user_data()
-sx = SXController(cluster, user_data)
 
-downloader = SXFileCat(sx)
-uploader = SXFileUploader(sx)
+class Client(object):
+    """Connection to a cluster. Every cluster has its own connection pool,
+    see `get_client`."""
+
+    def __init__(self, conf):
+        self.cluster = _get_cluster(conf)
+        # Also signs the block requests made by nginx, see the offload module
+        self.user_data = _get_user_data(conf)
+        self.sx = instrument(SXController(self.cluster, self.user_data))
+        _set_block_timeout(self.sx.session)
+        # sxclient caches the uuid by the method name, i.e. the same one
+        # for all clusters
+        self.sx.get_cluster_uuid = once(
+            lambda: SXController.get_cluster_uuid.refresh(self.sx))
+        self.downloader = SXFileCat(self.sx)
+        self.uploader = SXFileUploader(self.sx)
+
+
+def _set_block_timeout(session):
+    # sxclient waits for answers forever: block fetches hung on a stalled
+    # node would hold their threads (see download.fetch_blocks) for good
+    send = session.send
+
+    @wraps(send)
+    def wrapped(request, **kwargs):
+        if kwargs.get('timeout') is None and request.method == 'GET' and \
+                request.path_url.startswith('/.data/'):
+            kwargs['timeout'] = settings.DOWNLOAD_BLOCK_TIMEOUT
+            try:
+                return send(request, **kwargs)
+            except requests.Timeout as e:
+                raise SXClusterRequestTimeout(str(e))
+        return send(request, **kwargs)
+    session.send = wrapped
+
+
+def instrument(controller):
+    """Record metrics and traces for every query made by the given
+    SXController."""
+    for name in controller.available_operations:
+        operation = getattr(controller, name)
+        operation.call_on_node = _instrument_call(name, operation.call_on_node)
+    return controller
+
+
+def _instrument_call(name, call_on_node):
+    @wraps(call_on_node)
+    def wrapped(node, *args, **kwargs):
+        start = time.time()
+        status = 'error'
+        # Answered by the cluster, errors of the request (e.g. missing
+        # files) included
+        answered = False
+        try:
+            response = call_on_node(node, *args, **kwargs)
+            status = 'ok'
+            answered = True
+            return response
+        except (SXClusterNotFound, SXClusterClientError):
+            answered = True
+            raise
+        finally:
+            duration = time.time() - start
+            sent = received = 0
+            if status == 'ok':
+                sent = len(response.request.body or '')
+                received = len(response.content)
+                metrics.sx_bytes.inc(sent, method=name, direction='sent')
+                metrics.sx_bytes.inc(received, method=name,
+                                     direction='received')
+            admission.record(name, duration, answered)
+            metrics.sx_requests.inc(method=name, status=status)
+            metrics.sx_request_duration.observe(duration, method=name)
+            tracing.record_call(name, node, duration, sent=sent,
+                                received=received, status=status)
+    return wrapped
 
 
-@register()
+_init_lock = threading.RLock()
+
+
+def once(func):
+    """Call `func` on first use only, even if used from many threads."""
+    result = []
+
+    @wraps(func)
+    def wrapped():
+        if not result:
+            with _init_lock:
+                if not result:
+                    result.append(func())
+        return result[0]
+    return wrapped
+
+
+def per_cluster(func):
+    """Like `once`, but once for every cluster."""
+    results = {}
+
+    @wraps(func)
+    def wrapped():
+        name = current_cluster()
+        if name not in results:
+            with _init_lock:
+                if name not in results:
+                    results[name] = func()
+        return results[name]
+    return wrapped
+
+
+_clients = {}
+
+
+def get_client(name=None):
+    """Return the Client of a cluster, by default of the current one."""
+    if name is None:
+        name = current_cluster()
+    client = _clients.get(name)
+    if client is None:
+        with _init_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = Client(_get_conf(name))
+    return client
+
+
+@once
+def _get_hosts():
+    hosts = {}
+    for name, conf in settings.SX_CLUSTERS.iteritems():
+        for host in _as_list(conf.get('hosts') or []):
+            hosts[host.lower()] = name
+    return hosts
+
+
+def _as_list(value):
+    if not isinstance(value, list):
+        value = [value]
+    return value
+
+
+class _ClientProxy(object):
+    """Forwards to an attribute of the current cluster's Client."""
+
+    def __init__(self, attr):
+        self._attr = attr
+
+    def __getattr__(self, name):
+        return getattr(getattr(get_client(), self._attr), name)
+
+
+# Nothing is read or connected until first use, see `core.warmup`
+cluster = _ClientProxy('cluster')
+sx = _ClientProxy('sx')
+downloader = _ClientProxy('downloader')
+uploader = _ClientProxy('uploader')
+
+
+@register(deploy=True)
 def sx_check(app_configs, **kwargs):
-    """Smoketest the connection with SX cluster."""
+    """Smoketest the connection with SX cluster.
+
+    Only run with `check --deploy`, so that every management command
+    doesn't query the cluster.
+    """
     errors = []
-    try:
-        sx.listUsers.call()
-    except SXClientException as e:
-        logger.critical(
-            "Couldn't initialize sx console. Error message: " + e.message)
-        hint = "Check if your sx user has admin priveleges." \
-            if '403' in e.message else None
-        errors.append(Critical("SXClient error ocurred: {}".format(e),
-                               hint=hint))
+    for name in get_clusters():
+        try:
+            get_client(name).sx.listUsers.call()
+        except SXClientException as e:
+            logger.critical(
+                "Couldn't initialize sx console for cluster '{}'. "
+                "Error message: {}".format(name, e.message))
+            hint = "Check if your sx user has admin priveleges." \
+                if '403' in e.message else None
+            errors.append(Critical(
+                "SXClient error ocurred on cluster '{}': {}".format(name, e),
+                hint=hint))
     return errors
@@ -0,0 +1,204 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Listing the members of shared archives without downloading them.
+
+A zip archive ends with its central directory, so listing it takes the last
+block of the file (holding the end of central directory record) and the
+blocks holding the directory itself - usually a couple of blocks, however
+big the archive is. Tar archives have no index: every member has a header
+in front of its content, so listing one fetches a block per member (at most
+`settings.PREVIEW_ARCHIVE_ENTRIES` of them), skipping the content.
+
+Compressed tar archives can't be listed without reading them whole, so
+they aren't supported.
+
+Only the last `CACHED_BLOCKS` blocks read are kept, and a listing fetches at
+most `MAX_FETCHES` blocks, `MAX_FETCH_SIZE` bytes in total: tar archives of
+big blocks or many members are listed in part.
+"""
+
+from __future__ import unicode_literals
+
+import tarfile
+import zipfile
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+
+from sxshare import download
+from sxshare.core import File
+
+
+CACHED_BLOCKS = 4
+MAX_FETCHES = 256
+MAX_FETCH_SIZE = 32 * 1024 * 1024
+
+
+class ArchiveError(Exception):
+    """The file is not a valid (or supported) archive."""
+
+
+class ReadLimitExceeded(ArchiveError):
+    """Listing the archive would fetch too many blocks."""
+
+
+class BlockFile(object):
+    """Read-only, seekable file object over the blocks of a file on the
+    cluster. Only the blocks which are read from are fetched, and the last
+    `CACHED_BLOCKS` of them kept.
+
+    Raises ReadLimitExceeded once `MAX_FETCHES` blocks or `MAX_FETCH_SIZE`
+    bytes were fetched.
+    """
+
+    def __init__(self, volume, path):
+        info = download.get_file_info(volume, path)
+        if info['filter']:
+            # Compressed content can only be read from the start
+            raise ArchiveError("Files on volumes with filters can't be "
+                               "listed.")
+        self.size = info['fileSize']
+        self.stream = download.BlockStream(info)
+        self.blocks = OrderedDict()  # index: content, least recent first
+        self.fetches = 0
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError("Invalid offset: {}".format(offset))
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self.size, self.position + size)
+        block_size = self.stream.block_size
+        chunks = []
+        while self.position < end:
+            index, offset = divmod(self.position, block_size)
+            chunk = self._get_block(index)[
+                offset:offset + end - self.position]
+            chunks.append(chunk)
+            self.position += len(chunk)
+        return b''.join(chunks)
+
+    def _get_block(self, index):
+        block = self.blocks.pop(index, None)
+        if block is None:
+            self.fetches += 1
+            if self.fetches > MAX_FETCHES or \
+                    self.fetches * self.stream.block_size > MAX_FETCH_SIZE:
+                raise ReadLimitExceeded("Too many blocks to read")
+            block = self.stream.fetch(index)
+            if len(self.blocks) >= CACHED_BLOCKS:
+                self.blocks.popitem(last=False)
+        self.blocks[index] = block
+        return block
+
+
+def list_members(volume, path, limit=None):
+    """Return the members of a zip or tar archive as `core.File` objects,
+    and whether all of them were listed (at most `limit`, by default
+    `settings.PREVIEW_ARCHIVE_ENTRIES`, are).
+
+    Raises ArchiveError if the file is not a valid archive.
+    """
+    if limit is None:
+        limit = settings.PREVIEW_ARCHIVE_ENTRIES
+    f = BlockFile(volume, path)
+    if path.lower().endswith(b'.tar'):
+        iterator = _list_tar(f, limit + 1)
+    else:
+        iterator = _list_zip(f)
+    members = []
+    try:
+        for member in iterator:
+            members.append(member)
+    except ReadLimitExceeded:
+        if not members:
+            raise
+        return members[:limit], False
+    return members[:limit], len(members) <= limit
+
+
+def _list_zip(f):
+    try:
+        archive = zipfile.ZipFile(f)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile) as e:
+        raise ArchiveError(e)
+    for info in archive.infolist():
+        name = info.filename
+        if isinstance(name, bytes):  # Not flagged as utf-8
+            name = name.decode('cp437')
+        try:
+            date = datetime(*info.date_time)
+        except ValueError:
+            date = None
+        yield File(name=name, size=info.file_size, creation_date=date)
+
+
+def _list_tar(f, limit):
+    offset = 0
+    count = 0
+    long_name = None
+    pax = {}
+    while count < limit and offset + tarfile.BLOCKSIZE <= f.size:
+        f.seek(offset)
+        header = f.read(tarfile.BLOCKSIZE)
+        if header == tarfile.NUL * tarfile.BLOCKSIZE:
+            return  # End of archive
+        try:
+            info = tarfile.TarInfo.frombuf(header)
+        except tarfile.HeaderError as e:
+            raise ArchiveError(e)
+        offset += tarfile.BLOCKSIZE
+        data_offset = offset
+        size = int(pax.get('size', info.size))
+        offset += -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+        # Extended headers describe the next member
+        if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE):
+            f.seek(data_offset)
+            data = f.read(info.size)
+            if info.type == tarfile.GNUTYPE_LONGNAME:
+                long_name = data.rstrip(tarfile.NUL)
+            else:
+                pax = _parse_pax(data)
+            continue
+        if info.type in (tarfile.XGLTYPE, tarfile.GNUTYPE_LONGLINK):
+            continue
+
+        name = pax.get('path') or long_name or info.name
+        if isinstance(name, bytes):
+            name = name.decode('utf-8', 'replace')
+        if info.isdir() and not name.endswith('/'):
+            name += '/'
+        yield File(name=name, size=size,
+                   creation_date=datetime.utcfromtimestamp(info.mtime))
+        count += 1
+        long_name = None
+        pax = {}
+
+
+def _parse_pax(data):
+    # Records are "<length> <key>=<value>\n"
+    fields = {}
+    while data:
+        length = data.partition(b' ')[0]
+        try:
+            end = int(length)
+        except ValueError:
+            end = 0
+        if end <= len(length):
+            raise ArchiveError("Invalid pax header")
+        key, _, value = data[len(length) + 1:end].partition(b'=')
+        fields[key.decode('utf-8')] = value.rstrip(b'\n').decode('utf-8')
+        data = data[end:]
+    return fields
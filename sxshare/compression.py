@@ -0,0 +1,93 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Streaming compression of downloads, negotiated with Accept-Encoding.
+
+Brotli is offered only if the brotli package is installed.
+"""
+
+from __future__ import unicode_literals
+
+import re
+import zlib
+from mimetypes import guess_type
+
+from django.conf import settings
+
+from sxshare.core import get_sxweb_type
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+compressible_types_re = re.compile(
+    r'^(text/.*|image/svg\+xml|application/(json|javascript|x-javascript|'
+    r'xml|.*\+xml|.*\+json|x-sh|x-csh|x-tex|x-latex|rtf|x-yaml|sql))$')
+
+
+def is_compressible(path):
+    """Whether a file is worth compressing, judging by its name."""
+    content_type, encoding = guess_type(path)
+    if encoding is not None:  # Already compressed, e.g. .tar.gz
+        return False
+    if get_sxweb_type(path) in ('source', 'text'):
+        return True
+    return bool(content_type and compressible_types_re.match(content_type))
+
+
+def parse_accept_encoding(header):
+    """Return a dict of content codings and their q-values."""
+    codings = {}
+    for part in header.split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        match = re.search(r'q\s*=\s*([0-9.]+)', params)
+        if match:
+            try:
+                q = float(match.group(1))
+            except ValueError:
+                q = 0
+        codings[coding] = q
+    return codings
+
+
+def choose_encoding(request):
+    """Return the best encoding accepted by the client, or None.
+
+    Ranged requests are never compressed, as ranges refer to the
+    uncompressed content.
+    """
+    if not settings.COMPRESSION_ENABLED or 'HTTP_RANGE' in request.META:
+        return None
+    accepted = parse_accept_encoding(
+        request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    best, best_q = None, 0
+    for encoding in ('br', 'gzip') if brotli else ('gzip',):
+        q = accepted.get(encoding, accepted.get('*', 0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress_stream(iterator, encoding):
+    """Compress a stream of chunks. Memory use doesn't depend on the size
+    of the stream."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(
+            quality=settings.COMPRESSION_BROTLI_QUALITY)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(
+            settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED,
+            16 + zlib.MAX_WBITS)  # With a gzip header
+        compress, finish = compressor.compress, compressor.flush
+    for chunk in iterator:
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
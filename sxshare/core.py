@@ -1,35 +1,67 @@
 # Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
 # License: MIT, see LICENSE for more details.
 
+import hashlib
 import json
 import os
+import re
 from datetime import datetime
+from fnmatch import fnmatchcase
 from io import BytesIO
-from itertools import chain
 from time import time
 
+from django.conf import settings
 from django.contrib.auth.hashers import make_password, check_password
 from django.utils.crypto import get_random_string
 from django.utils.functional import cached_property
-from sxclient import SXFileDownloader
-from sxclient.exceptions import SXClusterNotFound
+from sxclient.exceptions import SXClientException, SXClusterNotFound
 
 from utils import timeout
-from sxshare.api import sx, downloader, uploader
+from sxshare import (
+    download, filters, get_version, journal, logger, tokens, tracing)
+from sxshare.api import (
+    sx, downloader, uploader, get_clusters, per_cluster, use_cluster)
 
 
 share_links_volname = '__sharelinks__'
 notify_dir = 'notify'
+index_dir = 'index'
+uploads_dir = 'uploads'
 
 
-if share_links_volname not in sx.listVolumes.json_call()['volumeList']:
-    replica = len(sx.listNodes.json_call()['nodeList'])
-    sx.createVolume.call(
-        share_links_volname,
-        volumeSize=1024 * 1024 * 1024,  # 1gb
-        owner='admin',
-        replicaCount=replica,
-        maxRevisions=1)
+class IdempotencyConflict(ValueError):
+    """The idempotency key was used to share a file with other options."""
+
+
+@per_cluster
+def ensure_share_links_volume():
+    """Create the volume for link files, unless it already exists."""
+    if share_links_volname not in sx.listVolumes.json_call()['volumeList']:
+        replica = len(sx.listNodes.json_call()['nodeList'])
+        sx.createVolume.call(
+            share_links_volname,
+            volumeSize=1024 * 1024 * 1024,  # 1gb
+            owner='admin',
+            replicaCount=replica,
+            maxRevisions=1)
+
+
+def warmup():
+    """Set up everything that is otherwise done on first use, so that the
+    first requests of a worker aren't slower than the rest.
+
+    If the cluster is unavailable the error is only logged; initialization
+    is retried on first use and by the readiness check.
+    """
+    get_version()
+    for name in get_clusters():
+        try:
+            with use_cluster(name):
+                ensure_share_links_volume()
+        except SXClientException as e:
+            logger.error("Warmup failed on cluster '{}': {}".format(name, e))
+    if settings.LINKS_WRITE_BEHIND or journal.pending():
+        journal.start()  # Uploads links left over by a previous run
 
 
 def is_dir(path):
@@ -44,6 +76,12 @@ def split_path(path):
     return volname, path
 
 
+def escape_pattern(path):
+    """Escape wildcards, so that a listFiles filter matches `path`
+    literally."""
+    return re.sub(r'([\\?*\[\]])', r'\\\1', path)
+
+
 def get_filename(path):
     dir = is_dir(path)
     filename = path.strip('/').split('/')[-1]
@@ -52,12 +90,43 @@ def get_filename(path):
     return filename
 
 
-def share_file(path, expiration=None, password=None, email=None):
+def share_file(path, expiration=None, password=None, email=None,
+               idempotency_key=None, upload=None):
     """Create a info file, which stores information about the shared file.
 
     Returns token for the shared file url.
     Raises utils.timeout.TimeoutError if upload took too long
+
+    With `settings.LINKS_WRITE_BEHIND`, the file is saved to the local
+    journal instead and uploaded in the background, see the journal module.
+
+    Given an `idempotency_key`, the link created with the same key is
+    returned, as long as it's live; IdempotencyConflict is raised if it was
+    created with other options. With `settings.LINKS_DEDUPLICATE`, a live
+    link with the same options is returned, if at least half of the
+    requested expiration time is left. Both are looked up by an index file
+    (see `get_index_name`), not by listing the links.
+
+    Given `upload` (a dict of optional 'max_size' and 'max_files' limits),
+    an upload link to the directory is created instead, see the upload
+    module.
     """
+    options = hashlib.sha1(json.dumps(
+        [path, expiration, bool(password), email, upload])).hexdigest()
+    if idempotency_key is not None:
+        index_name = get_index_name('request', idempotency_key)
+    elif settings.LINKS_DEDUPLICATE:
+        index_name = get_index_name('options', options)
+    else:
+        index_name = None
+    if index_name is not None:
+        with timeout(error_message="Link lookup timed out."), \
+                tracing.span('token_lookup'):
+            token = find_link(index_name, options, password,
+                              expiration if idempotency_key is None else None)
+        if token is not None:
+            return token
+
     # Prepare the data
     filename = get_filename(path)
     data = {
@@ -70,16 +139,29 @@ def share_file(path, expiration=None, password=None, email=None):
         data['password'] = make_password(password)
     if email:
         data['notify'] = email
+    if upload is not None:
+        data['upload'] = upload
     data = json.dumps(data)
-    size = len(data)
-    stream = BytesIO(data)
+
+    if settings.LINKS_WRITE_BEHIND:
+        # Random tokens don't collide in practice, so only the journal is
+        # checked, without waiting for the cluster
+        token = new_token(filename)
+        while journal.get(token) is not None:
+            token = new_token(filename)
+        journal.append(token, data)
+        if index_name is not None:
+            journal.append(index_name, make_index(token, options, expiration))
+        return token
+
+    ensure_share_links_volume()
 
     # Generate a random token until it's unique
-    with timeout(error_message="Link generation timed out."):
-        suffix = '/' + filename.strip('/')
+    with timeout(error_message="Link generation timed out."), \
+            tracing.span('token_probe'):
         searching = True
         while searching:
-            token = get_random_string() + suffix
+            token = new_token(filename)
             try:
                 sx.getFileMeta.call(share_links_volname, token)
             except SXClusterNotFound:
@@ -87,23 +169,99 @@ def share_file(path, expiration=None, password=None, email=None):
 
     # Upload the file
     with timeout(seconds=55, error_message="Shared link upload timed out."):
-        uploader.upload_stream(share_links_volname, size, token, stream)
+        upload_link(token, data)
+        if index_name is not None:
+            upload_link(index_name, make_index(token, options, expiration))
+    return token
+
+
+def get_index_name(kind, key):
+    """Return the name of the index file of a link, in `index_dir`."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return '{}/{}.{}'.format(index_dir, kind, hashlib.sha1(key).hexdigest())
+
+
+def make_index(token, options, expiration=None):
+    """Return the content of an index file pointing at `token`."""
+    data = {'token': token, 'options': options}
+    if expiration:
+        data['expires_on'] = int(time()) + expiration
+    return json.dumps(data)
+
+
+def find_link(index_name, options, password=None, expiration=None):
+    """Return the token of the live link pointed at by an index file, if it
+    was shared with the same `options` (and `password`), or None.
+
+    With `expiration`, links with less than half of it left aren't
+    returned. Raises IdempotencyConflict if the options differ for an index
+    file of a request.
+    """
+    try:
+        index = json.loads(read_link_file(index_name))
+        token = index['token']
+    except (SXClusterNotFound, ValueError, KeyError):
+        return None
+    file = get_shared_file_info(token)
+    if file is None or file.is_expired:
+        return None
+    if index.get('options') != options or \
+            (password and not file.check_password(password)):
+        if index_name.startswith(index_dir + '/request.'):
+            raise IdempotencyConflict(
+                "Idempotency key was used to share a file with other "
+                "options.")
+        return None
+    if expiration and file.expiration_date and \
+            file.expiration_date - time() < expiration / 2:
+        return None
     return token
 
 
+def new_token(filename):
+    """Return a random token for a link, see `tokens.stamp`."""
+    return '{}{}/{}'.format(
+        tokens.stamp(), get_random_string(tokens.STAMPED_LENGTH - 2),
+        filename.strip('/'))
+
+
+def upload_link(token, data):
+    """Upload a link file to the share links volume."""
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    ensure_share_links_volume()
+    with tracing.span('token_upload'):
+        uploader.upload_stream(
+            share_links_volname, len(data), token, BytesIO(data))
+
+
 def get_shared_file_info(token):
     """Given a shared file token, return shared file info.
 
     If there is no token file, or if the token is expired, None is returned.
     """
     try:
-        data = downloader.get_file_content(share_links_volname, token)
-        data = json.loads(data)
+        data = json.loads(read_link_file(token))
         return SharedFile(data)
     except (SXClusterNotFound, ValueError, KeyError):
         return
 
 
+def read_link_file(name):
+    """Return the content of a file on the share links volume (a link or
+    an index file), including the files not uploaded yet.
+
+    Raises SXClusterNotFound if there is no such file.
+    """
+    # Not uploaded yet, see the journal module
+    data = journal.get(name)
+    if data is None:
+        with tracing.span('token_read'):
+            data = downloader.get_file_content(share_links_volname, name)
+    return data
+
+
 def create_download_marker(file, token, ip=None, path='', user_agent=''):
     """
     Create a marker file on the shared links volume for shared file given as
@@ -126,7 +284,8 @@ def create_download_marker(file, token, ip=None, path='', user_agent=''):
     size = len(data)
     stream = BytesIO(data)
 
-    uploader.upload_stream(share_links_volname, size, marker_path, stream)
+    with tracing.span('download_marker'):
+        uploader.upload_stream(share_links_volname, size, marker_path, stream)
 
 
 class SharedFile(object):
@@ -141,17 +300,37 @@ class SharedFile(object):
         self.password = data.get('password')
         self.expiration_date = data.get('expires_on')
         self.notify_email = data.get('notify')
+        self.upload = data.get('upload')
+        self._listings = {}
 
     @property
     def is_dir(self):
         return is_dir(self.path)
 
+    @property
+    def is_upload(self):
+        return self.upload is not None
+
+    @property
+    def volume_filter(self):
+        """The filter to undo to read files, see the filters module."""
+        return filters.get_volume_filter(self.volume)
+
     @property
     def is_expired(self):
         return self.expiration_date and time() > self.expiration_date
 
+    def _list(self, path, span):
+        # Cached, so that file info doesn't cost another request after
+        # checking that the file exists
+        if path not in self._listings:
+            with tracing.span(span):
+                self._listings[path] = sx.listFiles.json_call(
+                    self.volume, path)['fileList']
+        return self._listings[path]
+
     def exists(self):
-        files = sx.listFiles.json_call(self.volume, self.path)['fileList']
+        files = self._list(self.path, 'exists')
         if self.is_dir:
             # Path ends with a slash -> `files` is directory content
             return bool(files)
@@ -159,21 +338,33 @@ class SharedFile(object):
             # Given path 'file', may return '/file' or '/file/' (directory)
             return self.path in (f.lstrip('/').encode('utf-8') for f in files)
 
-    def get_downloader(self, path=''):
-        path = self.get_path(path)
-        with SXFileDownloader(sx) as dl:
-            iterator = dl.get_blocks_content_iterator(self.volume, path)
+    def get_info(self, path=''):
+        """Return the listing entry of a file (fileSize, fileRevision,
+        createdAt...).
 
-            # Peek into the iterator. If a file doesn't exist, exception will
-            # be raised instantly.
-            try:
-                peek = [iterator.next()]
-            except StopIteration:  # Empty file
-                peek = []
-            return chain(peek, iterator)
+        Raises SXClusterNotFound if there is no such file, e.g. if `path`
+        is a directory.
+        """
+        path = self.get_path(path)
+        files = self._list(path, 'file_info')
+        # Listed paths start with a slash and aren't escaped
+        name = '/' + re.sub(r'\\(.)', r'\1', path.lstrip('/'))
+        try:
+            return files[name.decode('utf-8')]
+        except KeyError:
+            raise SXClusterNotFound("No such file: {}".format(name))
+
+    def get_downloader(self, path='', start=0, end=None):
+        """Return an iterable over the content of a file, or over bytes
+        from `start` to `end` (exclusive)."""
+        path = self.get_path(path)
+        return download.iter_file_content(self.volume, path, start, end)
 
     def check_password(self, password):
-        return self.password is None or check_password(password, self.password)
+        if self.password is None:
+            return True
+        with tracing.span('check_password'):
+            return check_password(password, self.password)
 
     def get_path(self, path=''):
         """Returns a path in context of this directory."""
@@ -189,23 +380,97 @@ class SharedFile(object):
 
     def list_files(self, path=''):
         path = self.get_path(path)
-        files = sx.listFiles.json_call(self.volume, path)['fileList']
+        with tracing.span('list_files'):
+            files = sx.listFiles.json_call(self.volume, path)['fileList']
 
-        def to_file(path, data):
-            try:
-                creation_date = datetime.utcfromtimestamp(data['createdAt'])
-            except KeyError:
-                creation_date = None
-            return File(name=get_filename(path),
-                        size=data.get('fileSize'),
-                        creation_date=creation_date)
-        files = [to_file(k, v) for k, v in files.iteritems()
+        files = [File.from_listing(get_filename(k), v)
+                 for k, v in files.iteritems()
                  if not k.endswith('/.sxnewdir')]
 
         # Group directories and files, sort by name
         files = sorted(files, key=lambda f: (not f.is_dir, f.name))
         return files
 
+    def list_files_page(self, path='', limit=None, after=None,
+                        recursive=False):
+        """Return a page of a directory listing, sorted by path, and the
+        path of its last entry, to be passed as `after` for the next page
+        (None if this is the last page).
+
+        Names are relative to the listed directory. Recursive listings
+        contain files only.
+        """
+        path = self.get_path(path)
+        if not is_dir(path):
+            path += '/'
+        params = {}
+        if recursive:
+            params['recursive'] = True
+        if limit:
+            params['limit'] = str(limit)
+        if after is not None:
+            params['after'] = after
+        with tracing.span('list_files'):
+            files = sx.listFiles.json_call(
+                self.volume, path, **params)['fileList']
+
+        names = sorted(files)
+        last = names[-1] if limit and len(names) >= limit else None
+        # Listed paths start with a slash and aren't escaped
+        prefix = '/' + re.sub(r'\\(.)', r'\1', path.lstrip('/'))
+        prefix = prefix.decode('utf-8')
+        files = [File.from_listing(name[len(prefix):], files[name])
+                 for name in names
+                 if name.startswith(prefix) and
+                 not name.endswith('/.sxnewdir')]
+        return files, last
+
+    def search(self, pattern, path='', limit=None, batch_size=500):
+        """Yield files under a directory whose names match `pattern`.
+
+        The pattern may contain shell-style wildcards, but no slashes;
+        without wildcards, it matches names containing it. The cluster
+        filters the listing, which is fetched in batches, so results are
+        yielded as they arrive. Names are relative to the directory.
+        """
+        if '/' in pattern:
+            raise ValueError("Search pattern can't contain slashes.")
+        if not any(c in pattern for c in '*?['):
+            pattern = '*{}*'.format(pattern)
+        if isinstance(pattern, unicode):
+            pattern = pattern.encode('utf-8')
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        path = self.get_path(path)
+        if not is_dir(path):
+            path += '/'
+        prefix = ('/' + path.lstrip('/')).decode('utf-8')
+        filter = escape_pattern(path.lstrip('/')) + pattern
+        # Wildcards in the filter may match across directories
+        name_pattern = pattern.decode('utf-8')
+
+        count = 0
+        after = None
+        while True:
+            with tracing.span('search'):
+                files = sx.listFiles.json_call(
+                    self.volume, filter, recursive=True,
+                    limit=str(batch_size), after=after)['fileList']
+            names = sorted(files)
+            for name in names:
+                filename = get_filename(name)
+                if not name.startswith(prefix) or \
+                        filename == '.sxnewdir' or \
+                        not fnmatchcase(filename, name_pattern):
+                    continue
+                yield File.from_listing(name[len(prefix):], files[name])
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            if len(names) < batch_size:
+                return
+            after = names[-1]
+
     @cached_property
     def sxweb_type(self):
         return get_sxweb_type(self.path)
@@ -219,6 +484,16 @@ class File(object):
         self.size = size
         self.creation_date = creation_date
 
+    @classmethod
+    def from_listing(cls, name, data):
+        """Create from an entry of a listFiles response."""
+        try:
+            creation_date = datetime.utcfromtimestamp(data['createdAt'])
+        except KeyError:
+            creation_date = None
+        return cls(name=name, size=data.get('fileSize'),
+                   creation_date=creation_date)
+
     def __unicode__(self):
         return self.name
 
@@ -250,4 +525,6 @@ sxweb_types = {
         'txt', 'srt', 'md'},
     'image': {
         'png', 'gif', 'jpeg', 'jpg'},
+    'archive': {
+        'zip', 'jar', 'war', 'apk', 'tar'},
 }
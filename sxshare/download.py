@@ -0,0 +1,447 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Downloads of files from the cluster.
+
+Blocks (up to several MB each) are re-chunked into writes of
+`settings.DOWNLOAD_WRITE_SIZE`, so that the memory a stream holds in the
+WSGI server's buffers doesn't depend on the block size.
+
+Blocks are fetched from any of their replicas, with hedged requests when
+a node is slow to answer and retries when one fails (see `fetch_blocks`).
+Consecutive blocks held by the same node are fetched in batches, by a
+single request, sized from the latency and bandwidth of recent fetches (see
+`BatchSizer`), so that files of many small blocks aren't slowed down by
+request round-trips.
+"""
+
+from __future__ import unicode_literals
+
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from collections import deque
+from Queue import Queue
+
+from django.conf import settings
+from sizefield.utils import parse_size
+from sxclient.exceptions import SXClientException, SXClusterRequestTimeout
+
+from sxshare import filters, logger, metrics, tracing
+from sxshare.api import get_client, sx
+
+
+write_size = parse_size(settings.DOWNLOAD_WRITE_SIZE)
+
+# Block names per request, within the url length limits of the nodes
+MAX_BATCH_BLOCKS = 64
+MAX_BATCH_SIZE = 4 * 1024 * 1024
+# Until enough blocks were fetched to estimate the bandwidth
+DEFAULT_BATCH_SIZE = 256 * 1024
+# Batches take this many times the latency of a request, so that waiting
+# for the nodes takes a small part of the time
+BATCH_LATENCIES = 8
+
+
+def get_file_info(volume, path):
+    """Return the block list of a file, see the getFile operation, with the
+    `filter` to undo to read its content (see the filters module).
+    """
+    volume_filter = filters.get_volume_filter(volume)
+    info = sx.getFile.json_call(volume, path)
+    info['filter'] = volume_filter
+    return info
+
+
+# Block fetches
+
+class LatencyTracker(object):
+    """Latencies of recent block fetches (their durations, less the time
+    taken by the transfer), for picking the hedging delay."""
+
+    def __init__(self, size=1000, min_samples=20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self._percentiles = {}
+
+    def add(self, duration):
+        with self.lock:
+            self.samples.append(duration)
+            if len(self.samples) % self.min_samples == 0:
+                self._percentiles = {}  # Recompute from time to time
+
+    def percentile(self, p):
+        """Return the p-th percentile, or None if there are too few
+        samples."""
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            if p not in self._percentiles:
+                samples = sorted(self.samples)
+                index = min(len(samples) - 1, int(len(samples) * p / 100.))
+                self._percentiles[p] = samples[index]
+            return self._percentiles[p]
+
+
+class BatchSizer(object):
+    """Picks the size of block batches from recent fetches.
+
+    Like TCP's BBR, the latency is estimated as the shortest recent fetch,
+    and the bandwidth as the fastest one. A batch transfers
+    `BATCH_LATENCIES` times the data that fits in the latency.
+    """
+
+    def __init__(self, size=100):
+        self.samples = deque(maxlen=size)  # (bytes, seconds)
+        self.lock = threading.Lock()
+
+    def add(self, size, duration):
+        with self.lock:
+            self.samples.append((size, duration))
+
+    def estimate(self):
+        """Return the latency and bandwidth (bytes per second) of the
+        recent fetches, or None if there are none."""
+        with self.lock:
+            samples = [(size, duration) for size, duration in self.samples
+                       if duration > 0]
+        if not samples:
+            return None
+        return (min(duration for _, duration in samples),
+                max(float(size) / duration for size, duration in samples))
+
+    def transfer_time(self, size):
+        """Return the seconds it takes to transfer `size` bytes, less the
+        latency."""
+        estimate = self.estimate()
+        return size / estimate[1] if estimate else 0
+
+    def get_batch_blocks(self, block_size):
+        """Return the number of blocks to fetch per request."""
+        estimate = self.estimate()
+        if estimate is None:
+            size = DEFAULT_BATCH_SIZE
+        else:
+            latency, bandwidth = estimate
+            size = min(BATCH_LATENCIES * latency * bandwidth, MAX_BATCH_SIZE)
+        return max(1, min(int(size // block_size), MAX_BATCH_BLOCKS))
+
+
+latency = LatencyTracker()
+batches = BatchSizer()
+
+
+def get_hedge_delay(size=0):
+    """Return the hedging delay of a fetch of `size` bytes."""
+    delay = latency.percentile(settings.DOWNLOAD_HEDGE_PERCENTILE)
+    if delay is None:
+        return settings.DOWNLOAD_HEDGE_DEFAULT_DELAY
+    return max(delay, settings.DOWNLOAD_HEDGE_MIN_DELAY) + \
+        batches.transfer_time(size)
+
+
+def fetch_blocks(nodes, block_size, blocks):
+    """Fetch blocks from one of the replica nodes holding all of them,
+    with a single request. Return their contents, in order.
+
+    If a node doesn't answer within the hedging delay (a percentile of
+    recent fetch latencies, plus the expected transfer time), the request
+    is also sent to the next replica and whichever answers first wins.
+    Failed or timed out requests are retried on the next replicas, up to
+    `settings.DOWNLOAD_RETRIES` times.
+    """
+    nodes = list(nodes)
+    random.shuffle(nodes)  # Spread the load over the replicas
+    results = Queue()
+    trace = tracing.get_current_trace()
+    # The executor's threads don't know the cluster of this one
+    controller = get_client().sx
+    state = {'attempts': 0, 'pending': 0, 'timer': None}
+
+    def start():
+        node = nodes[state['attempts'] % len(nodes)]
+        state['attempts'] += 1
+        state['pending'] += 1
+        _executor.submit(
+            _fetch_on_node, results, trace, controller, node, block_size,
+            blocks)
+
+    def schedule(delay, event):
+        # Events of replaced timers are ignored
+        state['timer'] = next(_timer_ids)
+        _scheduler.schedule(delay, results, (event, state['timer']))
+
+    size = block_size * len(blocks)
+    start()
+    schedule(get_hedge_delay(size), 'hedge')
+    retries = 0
+    while True:
+        event, result = results.get()
+        if event == 'done':
+            # Only the winners, slower requests would delay the hedges
+            contents, duration = result
+            latency.add(max(0, duration - batches.transfer_time(size)))
+            batches.add(size, duration)
+            return contents
+        if event in ('hedge', 'timeout') and result != state['timer']:
+            continue
+        if event == 'hedge':
+            metrics.block_fetch_events.inc(event='hedged')
+            start()
+            schedule(settings.DOWNLOAD_BLOCK_TIMEOUT, 'timeout')
+            continue
+        if event == 'error':
+            state['pending'] -= 1
+            if state['pending']:
+                continue  # Another request may still succeed
+        if retries >= settings.DOWNLOAD_RETRIES:
+            metrics.block_fetch_events.inc(event='failed')
+            if event == 'timeout':
+                raise SXClusterRequestTimeout(
+                    "Timed out fetching blocks {}".format(', '.join(blocks)))
+            raise result
+        retries += 1
+        metrics.block_fetch_events.inc(event='retried')
+        start()
+        schedule(settings.DOWNLOAD_BLOCK_TIMEOUT, 'timeout')
+
+
+def _fetch_on_node(results, trace, controller, node, block_size, blocks):
+    tracing.set_current_trace(trace)
+    start = time.time()
+    # Sorted, as sxclient does. Unlike sxclient, repeated blocks (e.g. of
+    # zeros) are requested once
+    names = sorted(set(blocks))
+    try:
+        content = controller.getBlocks.call_on_node(
+            node, block_size, names).content
+        if len(content) != block_size * len(names):
+            raise SXClientException("Got {} bytes instead of {}".format(
+                len(content), block_size * len(names)))
+    except SXClientException as e:
+        logger.warning("Failed to fetch blocks {} from {}: {}".format(
+            ', '.join(blocks), node, e))
+        results.put(('error', e))
+    else:
+        offsets = {name: i * block_size for i, name in enumerate(names)}
+        contents = [content[offsets[name]:offsets[name] + block_size]
+                    for name in blocks]
+        results.put(('done', (contents, time.time() - start)))
+    finally:
+        tracing.set_current_trace(None)
+
+
+class Executor(object):
+    """Runs functions in reusable daemon threads, starting a new one when
+    all of them are busy, up to `max_threads`. Further functions wait for
+    a thread."""
+
+    def __init__(self, name, max_threads):
+        self.name = name
+        self.max_threads = max_threads
+        self.lock = threading.Lock()
+        self.pid = None
+        self.tasks = None
+        self.threads = 0
+        self.idle = 0
+        self.queued = 0
+
+    def submit(self, func, *args):
+        with self.lock:
+            if self.pid != os.getpid():  # Threads don't survive a fork
+                self.pid = os.getpid()
+                self.tasks = Queue()
+                self.threads = self.idle = self.queued = 0
+            if self.idle:
+                self.idle -= 1
+            elif self.threads < self.max_threads:
+                self.threads += 1
+                thread = threading.Thread(
+                    target=self.run, args=(self.tasks,), name=self.name)
+                thread.daemon = True
+                thread.start()
+            else:
+                self.queued += 1
+            self.tasks.put((func, args))
+
+    def run(self, tasks):
+        while True:
+            func, args = tasks.get()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Unhandled error in {}".format(self.name))
+            with self.lock:
+                if self.queued:
+                    self.queued -= 1
+                else:
+                    self.idle += 1
+
+
+class Scheduler(object):
+    """Puts items into queues after a delay, from a single thread.
+
+    Unlike with threading.Timer, no thread is started per call.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.cond = threading.Condition()
+        self.pid = None
+        self.heap = []
+
+    def schedule(self, delay, queue, item):
+        with self.cond:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.heap = []
+                thread = threading.Thread(target=self.run, name=self.name)
+                thread.daemon = True
+                thread.start()
+            heapq.heappush(self.heap, (
+                time.time() + delay, next(_timer_ids), queue, item))
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                delay = self.heap[0][0] - time.time()
+                if delay > 0:
+                    self.cond.wait(delay)
+                    continue
+                _, _, queue, item = heapq.heappop(self.heap)
+            queue.put(item)
+
+
+_executor = Executor('sxshare-block-fetch', settings.DOWNLOAD_FETCH_THREADS)
+_scheduler = Scheduler('sxshare-block-fetch-timers')
+_timer_ids = itertools.count()
+
+
+class BlockStream(object):
+    """Blocks of a file revision, fetched in batches."""
+
+    def __init__(self, info):
+        self.block_size = info['blockSize']
+        self.size = info['fileSize']
+        self.blocks = [block.items()[0] for block in info['fileData']]
+
+    def fetch(self, index):
+        """Fetch a block from the cluster."""
+        return self.fetch_batch(index, 1)[0]
+
+    def fetch_batch(self, index, count):
+        """Fetch `count` blocks held by the same node (see `batch_length`)
+        with a single request."""
+        batch = self.blocks[index:index + count]
+        nodes = set(batch[0][1]).intersection(*(n for _, n in batch[1:]))
+        contents = fetch_blocks(
+            nodes, self.block_size, [block for block, _ in batch])
+        # The last block is padded
+        last = index + count - 1
+        contents[-1] = contents[-1][:self.size - last * self.block_size]
+        return contents
+
+    def batch_length(self, index, end=None):
+        """Return the number of blocks from `index` (up to `end`) to fetch
+        with a single request: consecutive blocks held by the same node."""
+        if end is None:
+            end = len(self.blocks)
+        limit = min(end - index, batches.get_batch_blocks(self.block_size))
+        nodes = set(self.blocks[index][1])
+        count = 1
+        while count < limit:
+            nodes &= set(self.blocks[index + count][1])
+            if not nodes:
+                break
+            count += 1
+        return count
+
+    def iter_fetch(self, start, end):
+        """Fetch blocks from `start` to `end` (exclusive) in batches."""
+        index = start
+        while index < end:
+            count = self.batch_length(index, end)
+            for content in self.fetch_batch(index, count):
+                yield content
+            index += count
+
+
+class FileContent(object):
+    """Content of a file, or of a range of its bytes, iterated in chunks of
+    `write_size` bytes.
+
+    The content of files on volumes with filters is decoded, and can only
+    be read whole.
+    """
+
+    def __init__(self, info, start=0, end=None):
+        self.info = info
+        self.start = start
+        self.end = info['fileSize'] if end is None else end
+        self.size = self.end - self.start
+
+    def __iter__(self):
+        chunks = _read_range(self.info, self.start, self.end)
+        if self.info['filter']:
+            chunks = filters.decode(chunks, self.info['filter'])
+        return rechunk(chunks, write_size)
+
+
+def iter_file_content(volume, path, start=0, end=None):
+    """Return a FileContent iterable over the content of a file, or over
+    bytes from `start` to `end` (exclusive).
+
+    File info is fetched immediately, so that SXClusterNotFound is raised
+    here if the file doesn't exist.
+    """
+    info = get_file_info(volume, path)
+    if info['filter'] and (start or end not in (None, info['fileSize'])):
+        raise ValueError("Ranges of filtered files can't be read")
+    return FileContent(info, start, end)
+
+
+def rechunk(iterator, size):
+    """Split and join a stream of strings into chunks of `size` bytes (but
+    the last one).
+
+    Strings are sliced through memoryviews, so every byte is copied once,
+    into the chunk it ends up in; chunks of the right size are passed
+    through as they are.
+    """
+    pending = bytearray()
+    for data in iterator:
+        if not pending and len(data) == size:
+            yield data
+            continue
+        view = memoryview(data)
+        offset = 0
+        if pending:
+            offset = size - len(pending)
+            pending += view[:offset]
+            if len(pending) < size:
+                continue
+            yield bytes(pending)
+            pending = bytearray()
+        while len(view) - offset >= size:
+            yield view[offset:offset + size].tobytes()
+            offset += size
+        pending += view[offset:]
+    if pending:
+        yield bytes(pending)
+
+
+def _read_range(info, start, end):
+    stream = BlockStream(info)
+    block_size = stream.block_size
+    first = start // block_size
+    contents = stream.iter_fetch(first, (end - 1) // block_size + 1)
+    for index, content in enumerate(contents, first):
+        offset = index * block_size
+        yield content[max(0, start - offset):end - offset]
@@ -0,0 +1,120 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Filters of volumes, and decoding the content of their files.
+
+SX filters are applied by the clients: the cluster stores the filtered
+representation of files, and their listings (`fileSize` included) describe
+it. `undelete` and `attribs` leave the content as it is, so files on their
+volumes are shared like any other. Filters which change the content can
+only be shared once a decoder for their format is registered in `DECODERS`;
+until then their volumes are rejected with UnsupportedFilter.
+
+`aes256` needs the key of its users, so it can't have a decoder. The format
+written by the compression filter (`zcomp`, implemented by the C sxclient,
+not by the python one) hasn't been checked against real volumes, so it isn't
+decoded: serving a guess would corrupt every download from such volumes.
+
+Decoded files are streamed (see `decode`): the memory a download takes
+doesn't depend on the size of the file, but its decoded size isn't known
+until the end, and ranges of it can only be reached by decoding all that
+comes before. Downloads of such files are sent whole, without
+Content-Length, see `views.download_response`.
+"""
+
+from __future__ import unicode_literals
+
+import threading
+import time
+
+from sxclient.defaults import FILTER_UUID_TO_NAME
+
+from sxshare import metrics
+from sxshare.api import current_cluster, sx
+
+
+# Filters which don't change the content of files
+TRANSPARENT_FILTERS = {'undelete', 'attribs'}
+# Filter name: factory of a decompressobj-like decoder of its content
+DECODERS = {}
+# Bytes decoded at once, so that highly compressed blocks don't take more
+MAX_OUTPUT = 256 * 1024
+# Seconds the filter of a volume is remembered for
+VOLUME_CACHE_TTL = 300
+
+
+class UnsupportedFilter(Exception):
+    """The content of files on the volume can't be decoded."""
+
+
+def get_filter_name(volume_meta):
+    """Return the name of the filter which has to be undone to read files on
+    a volume with `volume_meta` (as listed, see listVolumes and
+    locateVolume), or None.
+
+    Raises UnsupportedFilter for filters which can't be undone.
+    """
+    value = volume_meta.get('filterActive')
+    if not value:
+        return None
+    # The uuid of the filter, hex-encoded, maybe followed by its version
+    uuid = value.lower().replace('-', '')[:32]
+    name = FILTER_UUID_TO_NAME.get(uuid)
+    if name in TRANSPARENT_FILTERS:
+        return None
+    if name not in DECODERS:
+        raise UnsupportedFilter(
+            "Volumes with the {} filter are not supported.".format(
+                name or 'unknown'))
+    return name
+
+
+class VolumeFilters(object):
+    """Filters of volumes, remembered for `VOLUME_CACHE_TTL` seconds by every
+    process (a volume's filter is set when it's created)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # (cluster, volume): (expiration time, name)
+
+    def get(self, volume):
+        key = (current_cluster(), volume)
+        with self.lock:
+            entry = self.entries.get(key)
+        hit = entry is not None and entry[0] > time.time()
+        metrics.cache_lookup('volume_filters', hit)
+        if hit:
+            return entry[1]
+        meta = sx.locateVolume.json_call(
+            volume, includeMeta=True)['volumeMeta']
+        name = get_filter_name(meta)
+        with self.lock:
+            self.entries[key] = (time.time() + VOLUME_CACHE_TTL, name)
+        return name
+
+
+_volume_filters = VolumeFilters()
+
+
+def get_volume_filter(volume):
+    """Return the name of the filter to undo for files on `volume`, or None.
+
+    Raises UnsupportedFilter, see `get_filter_name`.
+    """
+    return _volume_filters.get(volume)
+
+
+def decode(chunks, name):
+    """Decode the content of a file from its filtered representation, read
+    from `chunks`. Decoded chunks are at most `MAX_OUTPUT` bytes.
+    """
+    decoder = DECODERS[name]()
+    for chunk in chunks:
+        while chunk:
+            data = decoder.decompress(chunk, MAX_OUTPUT)
+            chunk = decoder.unconsumed_tail
+            if data:
+                yield data
+    data = decoder.flush()
+    if data:
+        yield data
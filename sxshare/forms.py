@@ -10,10 +10,11 @@ from sxclient import SXController, UserData
 from sxclient.exceptions import (
     InvalidUserKeyError, SXClientException, SXClusterClientError)
 
-from api import sx, cluster
+from api import sx, get_client
 
 from utils import timeout
 import core
+import filters
 
 
 class ShareFileForm(forms.Form):
@@ -23,6 +24,10 @@ class ShareFileForm(forms.Form):
     password = forms.CharField(validators=[MinLengthValidator(8)],
                                required=False)
     notify = forms.EmailField(required=False)
+    idempotency_key = forms.CharField(max_length=255, required=False)
+    upload = forms.BooleanField(required=False)
+    max_size = forms.IntegerField(min_value=1, required=False)
+    max_files = forms.IntegerField(min_value=1, required=False)
 
     def clean_expire_time(self):
         expire_time = self.cleaned_data['expire_time']
@@ -60,11 +65,16 @@ class ShareFileForm(forms.Form):
                 raise forms.ValidationError("No such volume: {}."
                                             .format(volume))
 
-            # Check for filters (they are unsupported)
-            meta = volume_data['volumeMeta']
-            if meta.get('filterActive'):
+            # Check for filters (only some can be undone, see the filters
+            # module)
+            try:
+                volume_filter = filters.get_filter_name(
+                    volume_data['volumeMeta'])
+            except filters.UnsupportedFilter as e:
+                raise forms.ValidationError(e.message)
+            if volume_filter and self.cleaned_data.get('upload'):
                 raise forms.ValidationError(
-                    "Volumes with filters are not supported yet.")
+                    "Files can't be uploaded to volumes with filters.")
 
             # Check if path is valid:
             with timeout(error_message="ShareFileForm.clean.clean_path: "
@@ -81,6 +91,9 @@ class ShareFileForm(forms.Form):
             elif not core.is_dir(path) and path not in matches:
                 raise forms.ValidationError(
                     "Specify the exact path of the file.")
+            elif self.cleaned_data.get('upload') and not core.is_dir(path):
+                raise forms.ValidationError(
+                    "Files can only be uploaded to a directory.")
 
             # Store the cleaned path
             self.cleaned_data['path'] = os.path.join(volume, path.lstrip('/'))
@@ -100,7 +113,7 @@ class ShareFileForm(forms.Form):
                 raise forms.ValidationError("Invalid access key.")
 
             # Check if this access key has access to given volume
-            user_sx = SXController(cluster, user_data)
+            user_sx = SXController(get_client().cluster, user_data)
             full_path = self.cleaned_data['path']
             volume, path = core.split_path(full_path)
             with timeout(error_message=""
@@ -113,6 +126,25 @@ class ShareFileForm(forms.Form):
                         "Provide a valid access key. "
                         "Make sure you have access to "
                         "the file you want to share.")
+            if self.cleaned_data.get('upload'):
+                check_write_access(user_sx, volume)
+
+        def check_write_access(user_sx, volume):
+            no_access = forms.ValidationError(
+                "Make sure you can write to the directory you want to "
+                "receive files in.")
+            with timeout(error_message=""
+                         "ShareFileForm.clean.check_write_access: "
+                         "Volume ACL listing timed out."):
+                try:
+                    user = user_sx.whoAmI.json_call()
+                    if user.get('role') == 'admin':
+                        return
+                    acl = user_sx.getVolumeACL.json_call(volume)
+                except SXClientException:
+                    raise no_access
+            if 'write' not in acl.get(user.get('whoami'), ()):
+                raise no_access
 
         try:
             clean_path()
@@ -0,0 +1,234 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Write-behind journal of new share links.
+
+With `settings.LINKS_WRITE_BEHIND` enabled, creating a link doesn't wait for
+the cluster: the link file is saved to a local journal
+(`settings.LINKS_JOURNAL_DIR`) and fsync'd, and the link is returned right
+away. A background thread in every worker process uploads journaled links
+to the share links volume, retrying with backoff, and drops them from the
+journal once uploaded. Links are looked up in the journal before the
+cluster, so they work immediately on this host.
+
+Every entry is a separate file, claimed with flock while it is uploaded, so
+the worker processes don't upload the same link twice. The journal is
+replayed when the thread starts, so links left over by a crashed or
+restarted worker are uploaded too. Entries remember the cluster they
+belong to, see `api.current_cluster`.
+"""
+
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from . import api, logger, metrics
+
+
+# Seconds between retries of a failed upload, doubled on each failure
+RETRY_MIN_INTERVAL = 1
+RETRY_MAX_INTERVAL = 300
+# Seconds between scans for entries of other processes
+SCAN_INTERVAL = 60
+# Seconds a journaled link usually takes to reach the cluster
+FLUSH_WINDOW = SCAN_INTERVAL + RETRY_MAX_INTERVAL
+
+
+def _entry_path(token, cluster):
+    if isinstance(token, bytes):
+        token = token.decode('utf-8')
+    key = '{}:{}'.format(cluster, token).encode('utf-8')
+    name = hashlib.sha1(key).hexdigest()
+    return os.path.join(settings.LINKS_JOURNAL_DIR, '{}.json'.format(name))
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def append(token, data):
+    """Durably save a link file to the journal and schedule its upload."""
+    directory = settings.LINKS_JOURNAL_DIR
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    cluster = api.current_cluster()
+    path = _entry_path(token, cluster)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({'token': token, 'data': data, 'cluster': cluster,
+                   'created': time.time()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    _fsync_dir(directory)
+    _uploader.start()
+    _uploader.wake()
+
+
+def get(token):
+    """Return the link file of a pending link, or None."""
+    if isinstance(token, bytes):
+        token = token.decode('utf-8')
+    entry = _read_entry(_entry_path(token, api.current_cluster()))
+    if entry is None or entry['token'] != token:
+        return None
+    return entry['data']
+
+
+def pending():
+    """Return the paths of the journal entries, oldest first."""
+    directory = settings.LINKS_JOURNAL_DIR
+    try:
+        names = os.listdir(directory)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    entries = []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:  # Just uploaded
+            continue
+    return [entry for _, entry in sorted(entries)]
+
+
+def _is_current(f, path):
+    """Return True if `path` is still the entry open as `f`: `append`
+    replaces entries of tokens appended again."""
+    try:
+        return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return False
+
+
+def _read_entry(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class Uploader(object):
+    """Uploads journaled links in a background thread of every process."""
+
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.failures = {}  # path: (failure count, time of next attempt)
+
+    def start(self):
+        """Start the upload thread, once per process."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.failures = {}
+            self.event = threading.Event()
+            thread = threading.Thread(target=self.run,
+                                      name='sxshare-link-journal')
+            thread.daemon = True
+            thread.start()
+
+    def wake(self):
+        self.event.set()
+
+    def run(self):
+        pid = self.pid
+        while pid == os.getpid():
+            self.event.clear()
+            delay = self.process()
+            self.event.wait(delay)
+
+    def process(self):
+        """Upload the due entries, return the seconds until the next
+        retry."""
+        entries = pending()
+        metrics.journal_pending.set(len(entries))
+        self.failures = {path: value for path, value
+                         in self.failures.iteritems() if path in entries}
+        now = time.time()
+        next_attempt = now + SCAN_INTERVAL
+        for path in entries:
+            failures, due = self.failures.get(path, (0, now))
+            if due > now:
+                next_attempt = min(next_attempt, due)
+                continue
+            try:
+                self.process_entry(path)
+            except Exception as e:
+                failures += 1
+                delay = min(RETRY_MAX_INTERVAL,
+                            RETRY_MIN_INTERVAL * 2 ** (failures - 1))
+                logger.warning(
+                    "Failed to upload a journaled link (attempt {}), "
+                    "retrying in {}s: {}".format(failures, delay, e))
+                metrics.journal_uploads.inc(result='failed')
+                self.failures[path] = (failures, time.time() + delay)
+                next_attempt = min(next_attempt, time.time() + delay)
+            else:
+                self.failures.pop(path, None)
+        return max(0, next_attempt - time.time())
+
+    def process_entry(self, path):
+        try:
+            f = open(path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:  # Uploaded by another process
+                return
+            raise
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return  # Being uploaded by another process
+                raise
+            if not _is_current(f, path):
+                return  # Uploaded, or replaced by a newer entry
+            try:
+                entry = json.load(f)
+            except ValueError:
+                logger.error("Dropping corrupt journal entry {}".format(path))
+                if _is_current(f, path):
+                    os.remove(path)
+                return
+            from sxshare.core import upload_link  # Which imports us
+            with api.use_cluster(
+                    entry.get('cluster', api.DEFAULT_CLUSTER)):
+                upload_link(entry['token'], entry['data'])
+            if _is_current(f, path):
+                os.remove(path)
+        metrics.journal_uploads.inc(result='uploaded')
+
+
+_uploader = Uploader()
+
+
+def start():
+    """Start uploading the journal, e.g. after a restart."""
+    _uploader.start()
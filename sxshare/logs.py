@@ -0,0 +1,249 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Logging which doesn't make requests wait for disks or SMTP servers.
+
+`configure` (see `settings.LOGGING_CONFIG`) moves the handlers listed in
+`LOGGING['queued']` behind a bounded queue, drained by a single background
+thread per process. If the queue fills up, records are dropped and counted
+(see `metrics.dropped_log_records`) instead of blocking.
+
+Error emails are rate limited by `ThrottledAdminEmailHandler`: the same
+error is mailed at most once per `settings.ERROR_EMAIL_INTERVAL` by all
+worker processes on the host, and the emails are sent in the background.
+
+`JSONFormatter` and `SamplingFilter` are used for structured access and
+event logs.
+"""
+
+from __future__ import unicode_literals
+
+import atexit
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import logging.config
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from Queue import Full, Queue
+
+from django.conf import settings
+from django.utils.log import AdminEmailHandler
+
+from sxshare import metrics
+
+
+QUEUE_SIZE = 10000
+# Seconds to wait for queued records to be written at exit
+EXIT_TIMEOUT = 5
+
+
+def configure(config):
+    """Configure logging from a dictConfig dict, queueing the handlers
+    listed under 'queued'."""
+    config = dict(config)
+    queued = set(config.pop('queued', ()))
+    logging.config.dictConfig(config)
+
+    wrappers = {}
+    names = list(config.get('loggers', ()))
+    loggers = [logging.getLogger(name) for name in names]
+    for logger in loggers + [logging.getLogger()]:
+        for handler in list(logger.handlers):
+            if handler.name not in queued:
+                continue
+            if handler.name not in wrappers:
+                wrappers[handler.name] = QueueHandler(handler)
+            logger.removeHandler(handler)
+            logger.addHandler(wrappers[handler.name])
+
+
+class Listener(object):
+    """Runs queued calls in a background thread, once per process."""
+
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = Queue(QUEUE_SIZE)
+            self.thread = threading.Thread(
+                target=self.run, args=(self.queue,), name='sxshare-logging')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue a call, or drop it if the queue is full."""
+        self.start()
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except Full:
+            metrics.dropped_log_records.inc()
+
+    def run(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            func, args, kwargs = item
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                pass  # Handlers report their own errors
+
+    def stop(self):
+        """Write out the queued records."""
+        if self.pid != os.getpid():
+            return
+        try:
+            self.queue.put(None, timeout=EXIT_TIMEOUT)
+        except Full:
+            return
+        self.thread.join(EXIT_TIMEOUT)
+
+
+_listener = Listener()
+atexit.register(_listener.stop)
+
+
+class QueueHandler(logging.Handler):
+    """Passes records to `target` in the background thread."""
+
+    def __init__(self, target):
+        logging.Handler.__init__(self, level=target.level)
+        self.target = target
+
+    def emit(self, record):
+        try:
+            # Arguments may change before the record is written
+            record.msg = record.getMessage()
+            record.args = None
+        except Exception:
+            self.handleError(record)
+            return
+        _listener.submit(self.target.handle, record)
+
+    def close(self):
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as JSON objects, including any fields passed in
+    `extra`."""
+    reserved = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        data = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).iteritems():
+            if key not in self.reserved and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, sort_keys=True, default=unicode)
+
+
+class SamplingFilter(logging.Filter):
+    """Passes a fraction (`rate`) of the records below WARNING, marking
+    them with their `sample_rate`."""
+
+    def __init__(self, rate=1):
+        logging.Filter.__init__(self)
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        record.sample_rate = self.rate
+        return random.random() < self.rate
+
+
+class ThrottledAdminEmailHandler(AdminEmailHandler):
+    """Emails errors to the admins, at most once per
+    `settings.ERROR_EMAIL_INTERVAL` for each kind of error (logger, place
+    and exception type) from all processes on this host.
+
+    The email is prepared here, but sent in the background thread.
+    """
+
+    def emit(self, record):
+        try:
+            self.suppressed = self.check(record)
+        except (IOError, OSError, ValueError):
+            self.suppressed = 0  # Better too many emails than none
+        if self.suppressed is not None:
+            AdminEmailHandler.emit(self, record)
+
+    def check(self, record):
+        """Return the number of emails suppressed since the last one, or
+        None if this one should be suppressed too."""
+        exc_type = record.exc_info[0].__name__ if record.exc_info else ''
+        key = hashlib.sha1('{}:{}:{}:{}'.format(
+            record.name, record.pathname, record.lineno, exc_type)
+            .encode('utf-8')).hexdigest()
+        now = time.time()
+        with _shared_state('emails') as state:
+            for name, (sent, _) in state.items():
+                if now - sent >= settings.ERROR_EMAIL_INTERVAL * 2:
+                    del state[name]
+            sent, suppressed = state.get(key, (0, 0))
+            if now - sent < settings.ERROR_EMAIL_INTERVAL:
+                state[key] = (sent, suppressed + 1)
+                return None
+            state[key] = (now, 0)
+            return suppressed
+
+    def format_subject(self, subject):
+        if self.suppressed:
+            subject = '{} (and {} more)'.format(subject, self.suppressed)
+        return AdminEmailHandler.format_subject(self, subject)
+
+    def send_mail(self, *args, **kwargs):
+        _listener.submit(AdminEmailHandler.send_mail, self, *args, **kwargs)
+
+
+@contextmanager
+def _shared_state(name):
+    """Lock and load a state file in `settings.STATE_DIR`. Changes made to
+    the yielded dict are saved, unless an exception is raised."""
+    directory = os.path.join(settings.STATE_DIR, 'logging')
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    path = os.path.join(directory, '{}.json'.format(name))
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+            yield state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
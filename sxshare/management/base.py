@@ -0,0 +1,43 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management import base
+
+from sxshare import api, metrics
+
+
+class BaseCommand(base.BaseCommand):
+    """Base class for sxshare commands, records the duration of each run.
+
+    Commands run on the default cluster, or on the one given with
+    --cluster.
+    """
+
+    @property
+    def command_name(self):
+        return self.__module__.rsplit('.', 1)[-1]
+
+    def create_parser(self, prog_name, subcommand):
+        parser = super(BaseCommand, self).create_parser(prog_name, subcommand)
+        parser.add_argument(
+            '--cluster', choices=api.get_clusters(),
+            default=api.DEFAULT_CLUSTER,
+            help="Cluster to run on, see 'clusters' in conf.yaml.")
+        return parser
+
+    def execute(self, *args, **options):
+        start = time.time()
+        status = 'error'
+        try:
+            with api.use_cluster(
+                    options.pop('cluster', None) or api.DEFAULT_CLUSTER):
+                output = super(BaseCommand, self).execute(*args, **options)
+            status = 'ok'
+            return output
+        finally:
+            metrics.command_duration.observe(
+                time.time() - start, command=self.command_name, status=status)
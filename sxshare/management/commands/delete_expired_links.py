@@ -3,17 +3,23 @@
 
 from __future__ import unicode_literals
 
-from django.core.management.base import BaseCommand, CommandError
+import json
+from time import time
+
+from django.core.management.base import CommandError
 
 from sxclient import SXClientException
-from sxshare import core
+from sxshare import core, upload
 from sxshare.api import sx
+from sxshare.management.base import BaseCommand
 
 
 class Command(BaseCommand):
     help = "Deletes expired shared file links and invalid files."
 
     def handle(self, *args, **kwargs):
+        core.ensure_share_links_volume()
+
         links = sx.listFiles.json_call(
             core.share_links_volname, recursive=True)
         links = links['fileList'].keys()
@@ -22,13 +28,20 @@ class Command(BaseCommand):
 
         deleted = failed = 0
         for filename in links:
-            file = core.get_shared_file_info(filename)
-            if file is None:
-                continue
-            if file.is_expired:
+            file = None
+            if filename.lstrip('/').startswith(core.uploads_dir + '/'):
+                continue  # Deleted with their upload links
+            elif filename.lstrip('/').startswith(core.index_dir + '/'):
+                expired = self.is_index_expired(filename)
+            else:
+                file = core.get_shared_file_info(filename)
+                expired = file is not None and file.is_expired
+            if expired:
                 self.stdout.write("Link '{}' has expired. Deleting..."
                                   .format(filename))
                 try:
+                    if file is not None and file.is_upload:
+                        upload.delete_markers(filename.lstrip('/'))
                     sx.deleteFile.json_call(core.share_links_volname, filename)
                     deleted += 1
                 except SXClientException as e:
@@ -38,3 +51,12 @@ class Command(BaseCommand):
                           .format(deleted, failed))
         if failed:
             raise CommandError("Failed to delete some files.")
+
+    def is_index_expired(self, filename):
+        """Index files expire with the link they point at."""
+        try:
+            index = json.loads(core.read_link_file(filename))
+        except (SXClientException, ValueError):
+            return False
+        expires_on = index.get('expires_on')
+        return bool(expires_on) and time() > expires_on
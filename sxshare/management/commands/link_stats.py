@@ -0,0 +1,50 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from sxshare import core, stats
+from sxshare.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Shows download counters of a link, or of the most downloaded "
+            "links. Counters uploaded by the worker processes are merged "
+            "automatically; run it with --compact once (on a single host) "
+            "to merge those uploaded by older versions.")
+    orders = ('downloads', 'bytes', 'last_download')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'token', nargs='?',
+            help="Link token, e.g. 'abcDEF123456/file.txt'.")
+        parser.add_argument(
+            '--top', type=int, default=10,
+            help="Number of links to show, if no token is given.")
+        parser.add_argument(
+            '--order', choices=self.orders, default='downloads',
+            help="Order of the links.")
+        parser.add_argument(
+            '--compact', action='store_true',
+            help="Merge the counters uploaded by this host and by older "
+                 "versions into the totals of this host first.")
+
+    def handle(self, *args, **kwargs):
+        core.ensure_share_links_volume()
+
+        if kwargs['compact']:
+            merged = stats.compact(legacy=True)
+            self.stdout.write("Merged {} batches.".format(merged))
+
+        if kwargs['token']:
+            links = [(kwargs['token'], stats.get(kwargs['token']))]
+        else:
+            key = self.orders.index(kwargs['order'])
+            links = stats.top(kwargs['top'], key)
+        for token, (downloads, size, last) in links:
+            last = datetime.fromtimestamp(last).isoformat(sep=b' ') \
+                if last else '-'
+            self.stdout.write("{}\t{} downloads\t{} bytes\tlast: {}".format(
+                token, downloads, size, last))
@@ -0,0 +1,47 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+from __future__ import unicode_literals
+
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from sxshare import tracing
+from sxshare.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Toggles sampling of requests into cProfile dumps "
+            "for all running worker processes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'rate', type=float, nargs='?',
+            help="Fraction of requests to profile, e.g. 0.01. "
+                 "0 disables profiling. Omit to show the current state.")
+        parser.add_argument(
+            '--duration', type=int, default=None,
+            help="Disable profiling automatically after this many seconds.")
+
+    def handle(self, *args, **kwargs):
+        control = tracing.profiling
+        rate = kwargs['rate']
+        if rate is not None:
+            if not 0 <= rate <= 1:
+                raise CommandError("Rate must be between 0 and 1.")
+            control.update(rate, duration=kwargs['duration'])
+
+        control.refresh()
+        if control.rate:
+            self.stdout.write("Profiling {:.2%} of requests.".format(
+                control.rate))
+            if control.until is not None:
+                until = datetime.fromtimestamp(control.until)
+                self.stdout.write("Until: {}".format(
+                    until.isoformat(sep=b' ')))
+            self.stdout.write("Profiles are saved in {}".format(
+                settings.PROFILING_DIR))
+        else:
+            self.stdout.write("Profiling is disabled.")
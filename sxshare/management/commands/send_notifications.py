@@ -11,13 +11,14 @@ from time import time
 
 from django.conf import settings
 from django.core.mail import send_mail
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import CommandError
 from django.core.urlresolvers import reverse
 from django.utils.functional import cached_property
 from user_agents import parse as parse_ua
 
 from sxshare import core
 from sxshare.api import sx, downloader
+from sxshare.management.base import BaseCommand
 from sxshare.views import SharedRelay
 
 
@@ -32,6 +33,8 @@ class Command(BaseCommand):
         return url
 
     def handle(self, *args, **kwargs):
+        core.ensure_share_links_volume()
+
         since, until = self.get_notification_interval()
 
         markers = self.get_markers(since, until)
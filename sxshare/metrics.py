@@ -0,0 +1,452 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Prometheus-style metrics.
+
+Every worker process keeps its metrics in memory and periodically dumps them
+to its own file in `settings.METRICS_DIR`. The scrape endpoint merges the
+files of all processes on the host, so it doesn't matter which worker
+happens to serve the scrape.
+
+Counters and histograms of processes that are gone are folded into a single
+archive file, so that totals never go backwards. Gauges are only reported
+for live processes.
+"""
+
+from __future__ import unicode_literals
+
+import atexit
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from . import logger
+
+
+FLUSH_INTERVAL = 5  # seconds
+ARCHIVE_NAME = 'archive.json'
+
+DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+COMMAND_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600)
+
+REGISTRY = OrderedDict()
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("Invalid labels for metric {}: {}".format(
+                self.name, ', '.join(sorted(labels))))
+        return tuple(unicode(labels[n]) for n in self.labelnames)
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+    def dump(self):
+        """Return a JSON-serializable list of samples."""
+        with self._lock:
+            return [[list(k), v] for k, v in self._values.iteritems()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        _flusher.start()
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        _flusher.start()
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        _flusher.start()
+        with self._lock:
+            self._values[key] = value
+
+    @contextmanager
+    def track(self, **labels):
+        """Increment the gauge for the duration of the block."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        _flusher.start()
+        with self._lock:
+            try:
+                data = self._values[key]
+            except KeyError:
+                data = self._values[key] = {
+                    'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data['buckets'][i] += 1
+            data['sum'] += value
+            data['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block, in seconds."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+
+# Views
+request_duration = Histogram(
+    'sxshare_request_duration_seconds',
+    "Time until a response is returned by a view (excludes streaming).",
+    ['view', 'method', 'status'])
+
+# SX cluster
+sx_requests = Counter(
+    'sxshare_sx_requests_total',
+    "Requests made to the SX cluster.",
+    ['method', 'status'])
+sx_request_duration = Histogram(
+    'sxshare_sx_request_duration_seconds',
+    "Duration of requests made to the SX cluster.",
+    ['method'])
+sx_bytes = Counter(
+    'sxshare_sx_bytes_total',
+    "Payload bytes exchanged with the SX cluster.",
+    ['method', 'direction'])
+
+# Streaming
+streamed_bytes = Counter(
+    'sxshare_streamed_bytes_total',
+    "Bytes streamed to clients.")
+active_streams = Gauge(
+    'sxshare_active_streams',
+    "Downloads currently being streamed.")
+offloaded_bytes = Counter(
+    'sxshare_offloaded_bytes_total',
+    "Bytes of downloads sent by nginx, see the offload module.")
+throttled_downloads = Counter(
+    'sxshare_throttled_downloads_total',
+    "Downloads rejected by a concurrency cap, by scope.",
+    ['scope'])
+
+# Load shedding, see the admission module
+admission_limit = Gauge(
+    'sxshare_admission_limit',
+    "Requests admitted at once, summed over the worker processes.")
+admission_in_flight = Gauge(
+    'sxshare_admission_in_flight',
+    "Admitted requests in progress.")
+shed_requests = Counter(
+    'sxshare_shed_requests_total',
+    "Requests answered with 503 because of the load, by priority "
+    "(interactive or bulk).",
+    ['priority'])
+
+# Caches
+cache_requests = Counter(
+    'sxshare_cache_requests_total',
+    "Cache lookups, by cache (missing_tokens or volume_filters) and "
+    "result (hit or miss).",
+    ['cache', 'result'])
+
+# Block fetches, see the download module
+block_fetch_events = Counter(
+    'sxshare_block_fetch_events_total',
+    "Block fetches which were hedged, retried, or failed for good.",
+    ['event'])
+
+# Write-behind link journal, see the journal module
+journal_pending = Gauge(
+    'sxshare_journal_pending_links',
+    "Links waiting in the local journal to be uploaded.")
+journal_uploads = Counter(
+    'sxshare_journal_uploads_total',
+    "Uploads of journaled links, by result (uploaded or failed).",
+    ['result'])
+
+# Unknown links, see the tokens module
+rejected_tokens = Counter(
+    'sxshare_rejected_tokens_total',
+    "Requests for unknown links rejected without querying the cluster, by "
+    "reason (cached or filtered).",
+    ['reason'])
+
+# Logging, see the logs module
+dropped_log_records = Counter(
+    'sxshare_dropped_log_records_total',
+    "Log records dropped because the logging queue was full.")
+
+# Management commands
+command_duration = Histogram(
+    'sxshare_command_duration_seconds',
+    "Duration of management command runs.",
+    ['command', 'status'], buckets=COMMAND_BUCKETS)
+
+
+def cache_lookup(cache, hit):
+    cache_requests.inc(cache=cache, result='hit' if hit else 'miss')
+
+
+def track_stream(iterator):
+    """Wrap a response iterator, counting active streams and sent bytes."""
+    with active_streams.track():
+        for chunk in iterator:
+            streamed_bytes.inc(len(chunk))
+            yield chunk
+
+
+# Multiprocess support
+
+class Flusher(object):
+    """Periodically dumps metrics of the current process to a file."""
+
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        return os.path.join(settings.METRICS_DIR, '{}.json'.format(self.pid))
+
+    def start(self):
+        """Start the flushing thread, once per process.
+
+        Must be called before a value is updated.
+        """
+        if self.pid == os.getpid() or not settings.METRICS_ENABLED:
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # Forked: values belong to the parent process
+                for metric in REGISTRY.itervalues():
+                    metric.reset()
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self.run,
+                                      name='sxshare-metrics-flush')
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        pid = self.pid
+        while pid == os.getpid():
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        if self.pid != os.getpid():
+            return
+        data = {
+            'pid': self.pid,
+            'metrics': {name: metric.dump()
+                        for name, metric in REGISTRY.iteritems()},
+        }
+        try:
+            _write_json(self.path, data)
+        except (IOError, OSError) as e:
+            logger.warning("Failed to write metrics: {}".format(e))
+
+
+_flusher = Flusher()
+atexit.register(_flusher.flush)
+
+
+def _write_json(path, data):
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _merge(target, metrics, include_gauges=True):
+    for name, samples in metrics.iteritems():
+        metric = REGISTRY.get(name)
+        if metric is None or (metric.type == 'gauge' and not include_gauges):
+            continue
+        values = target.setdefault(name, {})
+        for labels, value in samples:
+            key = tuple(labels)
+            if metric.type == 'histogram':
+                try:
+                    current = values[key]
+                except KeyError:
+                    values[key] = {'buckets': list(value['buckets']),
+                                   'sum': value['sum'],
+                                   'count': value['count']}
+                    continue
+                current['buckets'] = [
+                    a + b for a, b in zip(current['buckets'],
+                                          value['buckets'])]
+                current['sum'] += value['sum']
+                current['count'] += value['count']
+            else:
+                values[key] = values.get(key, 0) + value
+
+
+def collect():
+    """Merge metrics of all processes on this host."""
+    _flusher.flush()
+    directory = settings.METRICS_DIR
+    archive_path = os.path.join(directory, ARCHIVE_NAME)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return {}
+
+    with open(archive_path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            archive = {}
+            data = _read_json(archive_path)
+            if data is not None:
+                _merge(archive, data['metrics'], include_gauges=False)
+
+            merged = {}
+            dead = []
+            for name in names:
+                if not name.endswith('.json') or name == ARCHIVE_NAME:
+                    continue
+                path = os.path.join(directory, name)
+                data = _read_json(path)
+                if data is None:
+                    continue
+                if _is_alive(data['pid']):
+                    _merge(merged, data['metrics'])
+                else:
+                    _merge(archive, data['metrics'], include_gauges=False)
+                    dead.append(path)
+
+            if dead:
+                _write_json(archive_path, {
+                    'pid': 0,
+                    'metrics': {
+                        name: [[list(k), v] for k, v in values.iteritems()]
+                        for name, values in archive.iteritems()},
+                })
+                for path in dead:
+                    os.remove(path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    for name, values in archive.iteritems():
+        _merge(merged, {name: [[k, v] for k, v in values.iteritems()]},
+               include_gauges=False)
+    return merged
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format_labels(labelnames, labels, extra=()):
+    pairs = zip(labelnames, labels) + list(extra)
+    if not pairs:
+        return ''
+    parts = ['{}="{}"'.format(name, _escape_label(value))
+             for name, value in pairs]
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    merged = collect()
+    lines = []
+    for name, metric in REGISTRY.iteritems():
+        lines.append('# HELP {} {}'.format(name, metric.documentation))
+        lines.append('# TYPE {} {}'.format(name, metric.type))
+        values = merged.get(name, {})
+        for labels in sorted(values):
+            value = values[labels]
+            if metric.type == 'histogram':
+                bounds = list(metric.buckets) + [float('inf')]
+                counts = value['buckets'] + [value['count']]
+                for bound, count in zip(bounds, counts):
+                    lines.append('{}_bucket{} {}'.format(
+                        name,
+                        _format_labels(metric.labelnames, labels,
+                                       [('le', _format_value(bound))]),
+                        _format_value(count)))
+                label_string = _format_labels(metric.labelnames, labels)
+                lines.append('{}_sum{} {}'.format(
+                    name, label_string, _format_value(value['sum'])))
+                lines.append('{}_count{} {}'.format(
+                    name, label_string, _format_value(value['count'])))
+            else:
+                lines.append('{}{} {}'.format(
+                    name, _format_labels(metric.labelnames, labels),
+                    _format_value(value)))
+    return '\n'.join(lines) + '\n'
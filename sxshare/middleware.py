@@ -0,0 +1,210 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.conf import settings
+from django.http.request import split_domain_port
+from django.utils.cache import cc_delim_re
+from ipware.ip import get_ip
+
+from . import admission, api, logger, metrics, offload, tracing
+
+
+access_logger = logging.getLogger('sxshare.access')
+
+
+class AccessLogMiddleware(object):
+    """Log every request to the 'sxshare.access' logger, as JSON.
+
+    Server errors are logged as warnings, so that they aren't sampled out.
+    For streamed responses, the duration excludes streaming.
+    """
+
+    def process_request(self, request):
+        request._access_log_start = time.time()
+
+    def process_response(self, request, response):
+        start = getattr(request, '_access_log_start', None)
+        if start is None:
+            return response
+        status = response.status_code
+        size = response.get('Content-Length')
+        if size is not None:
+            size = int(size)
+        elif not response.streaming:
+            size = len(response.content)
+        access_logger.log(
+            logging.WARNING if status >= 500 else logging.INFO,
+            '{} {} {}'.format(request.method, request.path, status),
+            extra={
+                'method': request.method,
+                'path': request.path,
+                'status': status,
+                'duration': round(time.time() - start, 6),
+                'ip': get_ip(request),
+                'user_agent': request.META.get('HTTP_USER_AGENT', ''),
+                'view': getattr(request, '_metrics_view', None),
+                'size': size,
+            })
+        return response
+
+
+class MetricsMiddleware(object):
+    """Observe the latency of every view.
+
+    For streamed responses, only the time until the response object is
+    returned is measured; see `metrics.track_stream` for the rest.
+    """
+
+    def process_request(self, request):
+        request._metrics_start = time.time()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request._metrics_view = view_func.__name__
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is not None:
+            metrics.request_duration.observe(
+                time.time() - start,
+                view=getattr(request, '_metrics_view', '<unresolved>'),
+                method=request.method,
+                status=response.status_code)
+        return response
+
+
+class TracingMiddleware(object):
+    """Trace SX calls made by each request, log slow ones and sample
+    requests into profiles.
+
+    Streamed responses are finalized once the stream is exhausted or closed.
+    """
+
+    def process_request(self, request):
+        previous = tracing.end_trace()
+        if previous is not None and previous.profiler is not None:
+            # Leftover of a streamed response which was never iterated
+            previous.profiler.disable()
+        trace = tracing.start_trace(request)
+        if tracing.profiling.should_profile():
+            trace.profiler = tracing.new_profiler()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        trace = tracing.get_current_trace()
+        if trace is not None:
+            trace.view = view_func.__name__
+
+    def process_response(self, request, response):
+        trace = tracing.get_current_trace()
+        if trace is None:
+            return response
+        if response.streaming:
+            response.streaming_content = self.finalize_stream(
+                response.streaming_content, trace, response.status_code)
+        else:
+            self.finalize(trace, response.status_code)
+        return response
+
+    def finalize_stream(self, content, trace, status):
+        try:
+            for chunk in content:
+                yield chunk
+        finally:
+            self.finalize(trace, status)
+
+    def finalize(self, trace, status):
+        if tracing.get_current_trace() is trace:
+            tracing.end_trace()
+        if trace.profiler is not None:
+            trace.profiler.disable()
+            try:
+                tracing.dump_profile(trace.profiler, trace)
+            except (IOError, OSError) as e:
+                logger.warning("Failed to dump profile: {}".format(e))
+        tracing.log_if_slow(trace, status)
+
+
+class ClusterMiddleware(object):
+    """Serve the cluster configured for the requested hostname, see
+    `api.get_cluster_for_host`.
+
+    The cluster isn't reset after the response, since streamed responses
+    are read afterwards; every request sets it again.
+    """
+
+    def process_request(self, request):
+        host, _ = split_domain_port(request.get_host())
+        api.activate(api.get_cluster_for_host(host))
+
+
+class PublicCacheMiddleware(object):
+    """Drop `Vary: Cookie, Accept-Language` from publicly cacheable
+    responses.
+
+    These are added whenever the session or the language is looked up, but
+    public responses (see `views.set_cache_headers`) depend on neither, and
+    shared caches would otherwise keep a copy per client.
+    """
+    private_vary = {'cookie', 'accept-language'}
+
+    def process_response(self, request, response):
+        cache_control = cc_delim_re.split(response.get('Cache-Control', ''))
+        if 'public' not in cache_control or not response.has_header('Vary'):
+            return response
+        vary = [h for h in cc_delim_re.split(response['Vary'])
+                if h.lower() not in self.private_vary]
+        if vary:
+            response['Vary'] = ', '.join(vary)
+        else:
+            del response['Vary']
+        return response
+
+
+class AdmissionMiddleware(object):
+    """Shed requests beyond the adaptive limit of the process, see the
+    admission module.
+
+    Streamed responses hold their place until the stream is exhausted or
+    closed.
+    """
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not settings.ADMISSION_ENABLED or \
+                view_func.__name__ in admission.EXEMPT_VIEWS or \
+                offload.is_range_request(request):
+            return None
+        try:
+            admission.limiter.acquire()
+        except admission.Overloaded as e:
+            return admission.overloaded_response(e)
+        request._admitted = True
+        return None
+
+    def process_response(self, request, response):
+        if not getattr(request, '_admitted', False):
+            return response
+        request._admitted = False
+        if response.streaming:
+            response.streaming_content = admission.ReleasingStream(
+                response.streaming_content)
+        else:
+            admission.limiter.release()
+        return response
+
+
+class OffloadRangeMiddleware(object):
+    """Abort responses to ranges included by offload manifests, unless
+    they stream the range: nginx would include any other body in the
+    file, see the offload module."""
+
+    def process_response(self, request, response):
+        if offload.is_range_request(request) and not (
+                response.streaming and response.status_code == 200):
+            logger.error("Offloaded range failed with status {}".format(
+                response.status_code))
+            return offload.aborted_response()
+        return response
@@ -0,0 +1,210 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Letting nginx fetch the blocks of downloads, instead of the workers.
+
+With `settings.DOWNLOAD_OFFLOAD`, downloads of whole files are answered
+with an X-Accel-Redirect to the internal `MANIFEST_PREFIX` location, after
+the link and its password are checked and the download is counted. nginx
+requests the same url from sxshare again through that location, which sets
+the `X-Sxshare-Offload` header, and gets a manifest of the file: an SSI
+document including the blocks of the file, which nginx fetches from the SX
+nodes through the internal `BLOCKS_PREFIX` location, with requests signed
+here. The workers never see the content of the file. See INSTALLATION.txt
+for the nginx configuration.
+
+Every include fetches up to `RUN_SIZE` bytes (or
+`download.MAX_BATCH_BLOCKS` blocks) of consecutive blocks held by the same
+node, at most `IN_FLIGHT` of them at once. Requests are signed when the
+manifest is built, so long files are split into parts of `PART_SIZE`
+bytes, the next one included at the end of the previous one.
+If a block request fails, its blocks are streamed by sxshare instead (see
+`RANGE_PARAM`), as is the last block of the file, which is padded on the
+cluster. These ranges are signed, so that clients can't request them to
+skip download notifications and stats. They aren't shed, throttled or
+answered conditionally, and if one fails anyway, its response is aborted
+(see `middleware.OffloadRangeMiddleware`): nginx would splice an error
+page into the file.
+"""
+
+from __future__ import unicode_literals
+
+import random
+
+import requests
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.encoding import escape_uri_path
+from sxclient.query.auth import SXAuth
+
+from sxshare import download
+from sxshare.api import get_client
+
+
+MANIFEST_PREFIX = '/.sxshare-offload'
+BLOCKS_PREFIX = '/.sxshare-blocks'
+# Set by nginx in the MANIFEST_PREFIX location, and cleared in the others
+HEADER = 'HTTP_X_SXSHARE_OFFLOAD'
+# Query parameters of manifest parts and of ranges served by sxshare
+PART_PARAM = 'offload_part'
+RANGE_PARAM = 'offload_range'
+# Smaller files are served faster without the extra requests
+MIN_SIZE = 1024 * 1024
+RUN_SIZE = 4 * 1024 * 1024
+PART_SIZE = 256 * 1024 * 1024
+IN_FLIGHT = 4
+
+
+def can_offload(request, size, byte_range, encoding, volume_filter=None):
+    """Return True if nginx should send the requested content."""
+    return bool(settings.DOWNLOAD_OFFLOAD) and request.method == 'GET' and \
+        byte_range is None and not encoding and not volume_filter and \
+        size >= MIN_SIZE and RANGE_PARAM not in request.GET and \
+        not is_manifest_request(request)
+
+
+def is_manifest_request(request):
+    return bool(settings.DOWNLOAD_OFFLOAD) and bool(request.META.get(HEADER))
+
+
+def get_range(request, size):
+    """Return the byte range requested by a manifest, as (start, end), or
+    None if there is none or its signature is invalid."""
+    byte_range = _get_signed_range(request)
+    if byte_range is not None and 0 <= byte_range[0] < byte_range[1] <= size:
+        return byte_range
+    return None
+
+
+def is_range_request(request):
+    """Return True if the request is for a range included by a manifest."""
+    return _get_signed_range(request) is not None
+
+
+def _get_signed_range(request):
+    if not settings.DOWNLOAD_OFFLOAD:
+        return None
+    try:
+        value, signature = request.GET[RANGE_PARAM].rsplit('.', 1)
+        start, end = map(int, value.split('-'))
+    except (KeyError, ValueError):
+        return None
+    if not constant_time_compare(signature, _sign(request.path, value)):
+        return None
+    return start, end
+
+
+def aborted_response():
+    """Response which fails after its headers, so that nginx aborts the
+    download instead of including its body."""
+    def fail():
+        raise IOError("Offloaded range failed")
+        yield  # A generator, which raises once iterated
+    response = StreamingHttpResponse(fail())
+    response['Content-Length'] = 1
+    return response
+
+
+def redirect_response(request):
+    response = HttpResponse()
+    response['X-Accel-Redirect'] = MANIFEST_PREFIX + request.get_full_path()
+    return response
+
+
+def get_manifest(request, volume, path):
+    """Return the manifest (a part of it, for later parts) of a file."""
+    info = download.get_file_info(volume, path)
+    block_size = info['blockSize']
+    size = info['fileSize']
+    blocks = [block.items()[0] for block in info['fileData']]
+    full_blocks = size // block_size
+    part_blocks = max(1, PART_SIZE // block_size)
+    try:
+        part = int(request.GET.get(PART_PARAM, 0))
+    except ValueError:
+        part = 0
+    first = part * part_blocks
+    last = min(first + part_blocks, full_blocks)
+
+    client = get_client()
+    auth = SXAuth(client.user_data)
+    lines = []
+    for count, (start, end, node) in enumerate(
+            _iter_runs(blocks, first, last, block_size)):
+        fallback = _range_url(request, start * block_size, end * block_size)
+        lines.append('<!--# block name="r{}" -->{}<!--# endblock -->'.format(
+            count, _include(fallback)))
+        hashes = ''.join(block for block, _ in blocks[start:end])
+        url = client.cluster.get_host_url(node) + \
+            '/.data/{}/{}'.format(block_size, hashes)
+        headers = auth(requests.Request('GET', url).prepare()).headers
+        virtual = '{}/{}/{}/.data/{}/{}?{}'.format(
+            BLOCKS_PREFIX, client.cluster.scheme,
+            client.cluster.get_host_netloc(node), block_size, hashes,
+            _query([('date', headers['Date']),
+                    ('auth', headers['Authorization'].split(' ', 1)[1])]))
+        lines.append(_include(virtual, stub='r{}'.format(count),
+                              wait=count % IN_FLIGHT == IN_FLIGHT - 1))
+    if last < full_blocks:
+        next_part = MANIFEST_PREFIX + _url(request, PART_PARAM, part + 1)
+        lines.append(_include(next_part))
+    elif full_blocks * block_size < size:
+        lines.append(_include(
+            _range_url(request, full_blocks * block_size, size)))
+    return '\n'.join(lines)
+
+
+def _iter_runs(blocks, first, last, block_size):
+    # Yield (start, end, node) of runs of blocks held by the same node
+    run_blocks = max(1, min(RUN_SIZE // block_size,
+                            download.MAX_BATCH_BLOCKS))
+    start = first
+    while start < last:
+        nodes = set(blocks[start][1])
+        end = start + 1
+        while end < last and end - start < run_blocks:
+            common = nodes.intersection(blocks[end][1])
+            if not common:
+                break
+            nodes = common
+            end += 1
+        yield start, end, random.choice(sorted(nodes))
+        start = end
+
+
+def _url(request, param, value):
+    # The url of the download, with one of the offload parameters
+    query = request.GET.copy()
+    for name in (PART_PARAM, RANGE_PARAM):
+        query.pop(name, None)
+    query['download'] = ''
+    query[param] = value
+    return '{}?{}'.format(escape_uri_path(request.path), query.urlencode())
+
+
+def _range_url(request, start, end):
+    value = '{}-{}'.format(start, end)
+    return _url(request, RANGE_PARAM,
+                '{}.{}'.format(value, _sign(request.path, value)))
+
+
+def _sign(path, value):
+    # Ranges are only valid for the file they were signed for
+    return salted_hmac('sxshare.offload.range',
+                       '{}?{}'.format(path, value)).hexdigest()
+
+
+def _query(params):
+    # Not escaped: nginx doesn't decode $arg_ variables, and the arguments
+    # of subrequests aren't parsed like those of request lines
+    return '&'.join('{}={}'.format(name, value) for name, value in params)
+
+
+def _include(virtual, stub=None, wait=False):
+    directive = '<!--# include virtual="{}"'.format(virtual)
+    if stub:
+        directive += ' stub="{}"'.format(stub)
+    if wait:
+        directive += ' wait="yes"'
+    return directive + ' -->'
@@ -5,6 +5,7 @@ from __future__ import unicode_literals
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import tempfile
 
 from django.utils.translation import ugettext_lazy as _
 
@@ -22,13 +23,16 @@ def _check_permissions(path):
         "accessible to other users: {}".format(path))
 
 # Path to SX Share config file
-_conf_path = os.path.join(BASE_DIR, 'conf.yaml')
+_conf_path = os.environ.get('SXSHARE_CONF') or \
+    os.path.join(BASE_DIR, 'conf.yaml')
 _check_permissions(_conf_path)
 with open(_conf_path) as f:
     _conf = yaml.safe_load(f)
     SERVER_CONF = _conf.get('server') or {}
     APP_CONF = _conf.get('app') or {}
     SX_CONF = _conf.get('sx') or {}
+    # More clusters by name, each served at its own `hosts`
+    SX_CLUSTERS = _conf.get('clusters') or {}
     EMAIL_CONF = _conf.get('mailing') or {}
 
 
@@ -50,6 +54,8 @@ DEBUG = SERVER_CONF.get('debug', False)
 
 if not DEBUG:
     ALLOWED_HOSTS = _as_list(SERVER_CONF['hosts'])
+    for _cluster_conf in SX_CLUSTERS.values():
+        ALLOWED_HOSTS += _as_list(_cluster_conf.get('hosts') or [])
 
 
 # Application definition
@@ -67,6 +73,13 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'sxshare.middleware.AccessLogMiddleware',
+    'sxshare.middleware.MetricsMiddleware',
+    'sxshare.middleware.TracingMiddleware',
+    'sxshare.middleware.ClusterMiddleware',
+    'sxshare.middleware.OffloadRangeMiddleware',
+    'sxshare.middleware.AdmissionMiddleware',
+    'sxshare.middleware.PublicCacheMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -135,6 +148,124 @@ if ADMINS:
     ADMINS = [('Admin', email) for email in _as_list(ADMINS)]
 
 
+# Runtime state shared by the worker processes on this host
+STATE_DIR = APP_CONF.get('state_dir') or \
+    os.path.join(tempfile.gettempdir(), 'sxshare')
+
+# Addresses allowed to access internal endpoints (e.g. metrics)
+INTERNAL_IPS = _as_list(APP_CONF.get('internal_ips') or '127.0.0.1')
+
+
+# Metrics
+METRICS_CONF = APP_CONF.get('metrics') or {}
+METRICS_ENABLED = METRICS_CONF.get('enabled', True)
+METRICS_DIR = METRICS_CONF.get('dir') or os.path.join(STATE_DIR, 'metrics')
+
+
+# Tracing and profiling
+TRACING_CONF = APP_CONF.get('tracing') or {}
+# Requests slower than this many seconds are logged with their SX calls
+TRACING_SLOW_THRESHOLD = TRACING_CONF.get('slow_request_threshold', 2)
+PROFILING_DIR = TRACING_CONF.get('profile_dir') or \
+    os.path.join(STATE_DIR, 'profiles')
+
+
+# Downloads
+DOWNLOAD_CONF = APP_CONF.get('downloads') or {}
+# Size of the chunks written to clients
+DOWNLOAD_WRITE_SIZE = DOWNLOAD_CONF.get('write_size') or '64 KB'
+# A block request slower than this percentile of recent ones is repeated on
+# another replica, but not sooner than after the minimum delay
+DOWNLOAD_HEDGE_PERCENTILE = DOWNLOAD_CONF.get('hedge_percentile', 95)
+DOWNLOAD_HEDGE_MIN_DELAY = DOWNLOAD_CONF.get('hedge_min_delay', 0.05)
+# Until enough requests were made to compute the percentile
+DOWNLOAD_HEDGE_DEFAULT_DELAY = 1
+# Failed or timed out block requests are retried on other replicas
+DOWNLOAD_RETRIES = DOWNLOAD_CONF.get('retries', 3)
+DOWNLOAD_BLOCK_TIMEOUT = DOWNLOAD_CONF.get('block_timeout', 30)
+# Threads sending block requests, per process; further requests wait
+DOWNLOAD_FETCH_THREADS = DOWNLOAD_CONF.get('fetch_threads', 64)
+# Let nginx fetch the blocks of whole files, see the offload module
+DOWNLOAD_OFFLOAD = DOWNLOAD_CONF.get('offload', False)
+
+# Previews
+PREVIEW_CONF = APP_CONF.get('previews') or {}
+# Archive previews list at most this many members
+PREVIEW_ARCHIVE_ENTRIES = PREVIEW_CONF.get('archive_entries', 1000)
+
+# Uploads
+UPLOAD_CONF = APP_CONF.get('uploads') or {}
+# Block requests in flight per upload, each holding up to 4 MB of the file
+UPLOAD_PARALLEL_REQUESTS = UPLOAD_CONF.get('parallel_requests', 4)
+# Threads sending block requests, per process; further requests wait
+UPLOAD_THREADS = UPLOAD_CONF.get('threads', 16)
+
+# Load shedding, see the admission module
+ADMISSION_CONF = APP_CONF.get('admission') or {}
+ADMISSION_ENABLED = ADMISSION_CONF.get('enabled', False)
+# Requests served at once by every worker process
+ADMISSION_INITIAL_LIMIT = ADMISSION_CONF.get('initial_limit', 20)
+ADMISSION_MIN_LIMIT = ADMISSION_CONF.get('min_limit', 2)
+ADMISSION_MAX_LIMIT = ADMISSION_CONF.get('max_limit', 200)
+# SX requests this many times slower than usual decrease the limit
+ADMISSION_TOLERANCE = ADMISSION_CONF.get('tolerance', 3)
+# Share of the limit available to downloads, searches and uploads
+ADMISSION_BULK_SHARE = ADMISSION_CONF.get('bulk_share', 0.7)
+ADMISSION_RETRY_AFTER = ADMISSION_CONF.get('retry_after', 5)
+
+
+# Share links
+LINKS_CONF = APP_CONF.get('links') or {}
+# Return new links without waiting for the cluster, see the journal module
+LINKS_WRITE_BEHIND = LINKS_CONF.get('write_behind', False)
+LINKS_JOURNAL_DIR = LINKS_CONF.get('journal_dir') or \
+    os.path.join(STATE_DIR, 'journal')
+# Missing and expired tokens are remembered by every worker process
+LINKS_NEGATIVE_CACHE_TTL = LINKS_CONF.get('negative_cache_ttl', 60)
+LINKS_NEGATIVE_CACHE_SIZE = 10000
+# Reject unknown tokens using a filter of all tokens, see the tokens module
+LINKS_FILTER_ENABLED = LINKS_CONF.get('filter', False)
+LINKS_FILTER_INTERVAL = LINKS_CONF.get('filter_interval', 300)
+# Return an existing live link for repeated requests with the same options
+LINKS_DEDUPLICATE = LINKS_CONF.get('deduplicate', False)
+# Per-link download counters, see the stats module
+LINKS_STATS_ENABLED = LINKS_CONF.get('stats', True)
+# Seconds between uploads of the counters of each worker process
+LINKS_STATS_FLUSH_INTERVAL = LINKS_CONF.get('stats_flush_interval', 60)
+
+
+# JSON directory listings, see SharedDirView.json_listing
+LISTING_CONF = APP_CONF.get('listing') or {}
+LISTING_PAGE_SIZE = LISTING_CONF.get('page_size', 1000)
+LISTING_MAX_PAGE_SIZE = LISTING_CONF.get('max_page_size', 10000)
+# Searches (the `q` parameter) stop after this many matches
+SEARCH_MAX_RESULTS = LISTING_CONF.get('max_search_results', 1000)
+
+
+# Compression of text downloads, negotiated with the client
+COMPRESSION_CONF = APP_CONF.get('compression') or {}
+COMPRESSION_ENABLED = COMPRESSION_CONF.get('enabled', True)
+COMPRESSION_GZIP_LEVEL = COMPRESSION_CONF.get('gzip_level', 6)
+COMPRESSION_BROTLI_QUALITY = COMPRESSION_CONF.get('brotli_quality', 5)
+
+
+# Caching of public links by shared caches (CDN), in seconds; links which
+# expire sooner are cached until they expire
+PUBLIC_CACHE_MAX_AGE = APP_CONF.get('public_cache_max_age', 3600)
+
+
+# Download throttling, shared by the worker processes on this host
+THROTTLING_CONF = APP_CONF.get('throttling') or {}
+# Bandwidth limits per 'link', per 'client' IP and in 'total', in bytes per
+# second (or e.g. '10 MB')
+THROTTLING_RATE = THROTTLING_CONF.get('rate') or {}
+# Limits of concurrent downloads, with the same scopes
+THROTTLING_CONCURRENCY = THROTTLING_CONF.get('concurrency') or {}
+# Seconds after which rejected clients are asked to try again
+THROTTLING_RETRY_AFTER = THROTTLING_CONF.get('retry_after', 10)
+THROTTLING_DIR = os.path.join(STATE_DIR, 'throttling')
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -166,15 +297,30 @@ USE_TZ = True
 
 STATIC_URL = '/.sxshare/static/'
 STATICFILES_DIRS = (os.path.join(BASE_DIR, 'static'),)
-
-
+# Collected with hashed names and precompressed, see INSTALLATION.txt
+STATIC_ROOT = APP_CONF.get('static_root') or \
+    os.path.join(BASE_DIR, 'static_root')
+STATICFILES_STORAGE = 'sxshare.storage.CompressedManifestStaticFilesStorage'
+
+
+# Logging, see the logs module
+LOGGING_CONF = APP_CONF.get('logging') or {}
+LOG_DIR = LOGGING_CONF.get('dir') or ('' if DEBUG else '/srv/logs')
+# Format of django.log, 'text' or 'json'
+LOG_FORMAT = LOGGING_CONF.get('format') or 'text'
+# Fraction of requests logged to access.log (errors are always logged)
+LOG_ACCESS_SAMPLE_RATE = LOGGING_CONF.get('access_sample_rate', 1)
+# The same error is mailed to the admins at most once per this many seconds
+ERROR_EMAIL_INTERVAL = LOGGING_CONF.get('error_email_interval', 600)
+
+LOGGING_CONFIG = 'sxshare.logs.configure'
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'handlers': {
         'mail_admins': {
             'level': 'ERROR',
-            'class': 'django.utils.log.AdminEmailHandler',
+            'class': 'sxshare.logs.ThrottledAdminEmailHandler',
             'include_html': True,
         },
         'console': {
@@ -182,10 +328,18 @@ LOGGING = {
         },
         'file': {
             'class': 'logging.FileHandler',
-            'filename': '/srv/logs/django.log',
-            'formatter': 'file',
+            'filename': os.path.join(LOG_DIR, 'django.log'),
+            'formatter': LOG_FORMAT,
+        },
+        'access': {
+            'class': 'logging.FileHandler',
+            'filename': os.path.join(LOG_DIR, 'access.log'),
+            'formatter': 'json',
+            'filters': ['sample_access'],
         },
     },
+    # Written in a background thread
+    'queued': ['console', 'file', 'access'],
     'loggers': {
         'django': {
             'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
@@ -194,15 +348,30 @@ LOGGING = {
             'handlers': ['console', 'file'],
             'level': 'DEBUG',
         },
+        'sxshare.access': {
+            'handlers': ['access'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+    'filters': {
+        'sample_access': {
+            '()': 'sxshare.logs.SamplingFilter',
+            'rate': LOG_ACCESS_SAMPLE_RATE,
+        },
     },
     'formatters': {
-        'file': {
+        'text': {
             'format': '\n%(levelname)s %(asctime)s\n%(message)s'
         },
+        'json': {
+            '()': 'sxshare.logs.JSONFormatter',
+        },
     }
 }
 if DEBUG:
-    LOGGING['handlers']['file']['filename'] = 'django.log'
     LOGGING['loggers']['django']['handlers'] = ['console']
 else:
     LOGGING['loggers']['django']['handlers'] = ['mail_admins', 'file']
+if not LOG_ACCESS_SAMPLE_RATE:
+    LOGGING['loggers']['sxshare.access']['handlers'] = []
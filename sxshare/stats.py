@@ -0,0 +1,330 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Per-link download counters.
+
+Every worker process counts the downloads of each link (downloads, bytes
+sent and the time of the last download) in memory, and periodically uploads
+the counts collected since the previous flush as a single batch file to the
+share links volume (`stats/batch.<host>.*`). Every `COMPACT_INTERVAL`
+seconds, one process of each host merges the batches of the host into its
+totals file (`stats/totals.<host>.json`), so reading the stats of all links
+takes a few requests per host, no matter how many downloads there were.
+
+Hosts are told apart by an id kept in `settings.STATE_DIR`: each host only
+merges its own batches, serialized with flock, so merges never run
+concurrently. A host whose state directory is lost starts new totals, and
+the batches it left behind are still read, but not merged.
+
+Totals remember which batches they include, so a merge interrupted before
+the batches were deleted doesn't count them twice. Batches and totals
+(`stats/totals.json`) uploaded by older versions are read too, and merged
+by `compact(legacy=True)`, see the `link_stats` command.
+"""
+
+from __future__ import unicode_literals
+
+import atexit
+import errno
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from django.conf import settings
+from django.utils.crypto import get_random_string
+from sxclient.exceptions import SXClientException, SXClusterNotFound
+
+from sxshare import logger
+from sxshare.api import (
+    current_cluster, get_clusters, sx, downloader, uploader, use_cluster)
+from sxshare.core import ensure_share_links_volume, share_links_volname
+
+
+stats_dir = 'stats'
+# Totals of all hosts, merged by older versions
+legacy_totals_name = 'stats/totals.json'
+# Seconds between merges of the batches of a host
+COMPACT_INTERVAL = 600
+
+# Indexes of the counters of a link
+DOWNLOADS, BYTES, LAST_DOWNLOAD = range(3)
+
+
+def _merge(target, links):
+    for token, (downloads, size, last) in links.iteritems():
+        counters = target.setdefault(token, [0, 0, 0])
+        counters[DOWNLOADS] += downloads
+        counters[BYTES] += size
+        counters[LAST_DOWNLOAD] = max(counters[LAST_DOWNLOAD], last)
+
+
+class Collector(object):
+    """Counts downloads of the current process, uploaded in batches to the
+    cluster of each link."""
+
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+        self.links = {}  # {cluster: {token: counters}}
+
+    def start(self):
+        """Start the flushing thread, once per process."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                self.links = {}  # Forked: counted by the parent process
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self.run,
+                                      name='sxshare-link-stats-flush')
+            thread.daemon = True
+            thread.start()
+
+    def add(self, token, downloads=0, size=0):
+        self.start()
+        with self.lock:
+            links = self.links.setdefault(current_cluster(), {})
+            counters = links.setdefault(token, [0, 0, 0])
+            counters[DOWNLOADS] += downloads
+            counters[BYTES] += size
+            counters[LAST_DOWNLOAD] = int(time.time())
+
+    def run(self):
+        pid = self.pid
+        while pid == os.getpid():
+            time.sleep(settings.LINKS_STATS_FLUSH_INTERVAL)
+            self.flush()
+            try:
+                _compact_due()
+            except Exception as e:
+                logger.warning("Failed to merge link stats: {}".format(e))
+
+    def flush(self):
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            clusters, self.links = self.links, {}
+        for cluster, links in clusters.iteritems():
+            name = '{}/batch.{}.{}.{}.json'.format(
+                stats_dir, host_id(), int(time.time()), get_random_string())
+            data = json.dumps({'links': links})
+            try:
+                with use_cluster(cluster):
+                    ensure_share_links_volume()
+                    uploader.upload_stream(
+                        share_links_volname, len(data), name, BytesIO(data))
+            except SXClientException as e:
+                logger.warning("Failed to upload link stats of cluster "
+                               "'{}': {}".format(cluster, e))
+                with self.lock:  # Try again with the next batch
+                    _merge(self.links.setdefault(cluster, {}), links)
+
+
+_collector = Collector()
+atexit.register(_collector.flush)
+
+
+def track_download(token, iterator, count=True):
+    """Wrap a response iterator, counting sent bytes and, unless `count`
+    is false (e.g. for a continued download), the download."""
+    if not settings.LINKS_STATS_ENABLED:
+        for chunk in iterator:
+            yield chunk
+        return
+    if count:
+        _collector.add(token, downloads=1)
+    for chunk in iterator:
+        _collector.add(token, size=len(chunk))
+        yield chunk
+
+
+def count_download(token, size):
+    """Count a download sent by nginx, see the offload module."""
+    if settings.LINKS_STATS_ENABLED:
+        _collector.add(token, downloads=1, size=size)
+
+
+def _state_path(name):
+    directory = os.path.join(settings.STATE_DIR, stats_dir)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return os.path.join(directory, name)
+
+
+_host_id = None
+
+
+def host_id():
+    """Return the id of this host, created once in `settings.STATE_DIR`."""
+    global _host_id
+    if _host_id is None:
+        path = _state_path('host')
+        if not os.path.exists(path):
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(get_random_string())
+            try:
+                os.link(tmp_path, path)  # Unless another process was first
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.remove(tmp_path)
+        with open(path) as f:
+            _host_id = f.read().strip()
+    return _host_id
+
+
+def _batch_host(name):
+    """Return the host id of a batch, or None if an older version uploaded
+    it."""
+    parts = name.split('/')[-1].split('.')
+    return parts[1] if len(parts) == 5 else None
+
+
+def _totals_name(host):
+    return '{}/totals.{}.json'.format(stats_dir, host)
+
+
+def _read(name):
+    try:
+        data = downloader.get_file_content(share_links_volname, name)
+    except SXClusterNotFound:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError:
+        logger.error("Invalid link stats file: {}".format(name))
+        return None
+
+
+def _list():
+    """Return the names of the batches and of the totals."""
+    files = sx.listFiles.json_call(
+        share_links_volname, stats_dir + '/')['fileList']
+    names = sorted(name.lstrip('/') for name in files)
+    return ([name for name in names
+             if name.startswith(stats_dir + '/batch.')],
+            [name for name in names
+             if name.startswith(stats_dir + '/totals.')])
+
+
+def load():
+    """Return the counters of all links, {token: [downloads, bytes, last
+    download]}."""
+    batches, totals_names = _list()
+    totals = {}
+    merged = set()
+    for name in totals_names:
+        totals[name] = _read(name) or {}
+        merged.update(totals[name].get('merged', ()))
+
+    links = {}
+    for name, data in totals.iteritems():
+        if name not in merged:
+            _merge(links, data.get('links', {}))
+    for name in batches:
+        if name in merged:
+            continue
+        batch = _read(name)
+        if batch is not None:
+            _merge(links, batch['links'])
+    return links
+
+
+def get(token):
+    """Return the counters of a link."""
+    return load().get(token, [0, 0, 0])
+
+
+def top(count, key=DOWNLOADS):
+    """Return [(token, counters)] of the `count` links with the most
+    downloads (or bytes, or the latest downloads, see `key`)."""
+    return sorted(load().iteritems(), key=lambda item: item[1][key],
+                  reverse=True)[:count]
+
+
+@contextmanager
+def _compact_lock(blocking=True):
+    """Serialize the merges of this host, yield False if `blocking` is
+    false and another process is merging. The mtime of the lock file is
+    the time of the last merge."""
+    with open(_state_path('compact.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else
+                                               fcntl.LOCK_NB))
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                yield False
+                return
+            raise
+        yield True
+
+
+def compact(legacy=False):
+    """Merge the batches of this host into its totals, and with `legacy`,
+    the batches and totals uploaded by older versions (merge those on a
+    single host). Return the number of merged batches."""
+    with _compact_lock():
+        return _compact(legacy)
+
+
+def _compact(legacy):
+    host = host_id()
+    batches, totals_names = _list()
+    totals = _read(_totals_name(host)) or {}
+    links = totals.get('links', {})
+    merged = set(totals.get('merged', ()))
+    sources = [name for name in batches if _batch_host(name) == host or
+               (legacy and _batch_host(name) is None)]
+    if legacy and legacy_totals_name in totals_names:
+        old = _read(legacy_totals_name) or {}
+        if legacy_totals_name not in merged:
+            _merge(links, old.get('links', {}))
+        merged.update(old.get('merged', ()))
+        sources.append(legacy_totals_name)
+    for name in sources:
+        if name in merged or name == legacy_totals_name:
+            continue
+        batch = _read(name)
+        if batch is not None:
+            _merge(links, batch['links'])
+
+    data = json.dumps({'links': links, 'merged': sources})
+    uploader.upload_stream(
+        share_links_volname, len(data), _totals_name(host), BytesIO(data))
+    for name in sources:
+        try:
+            sx.deleteFile.json_call(share_links_volname, name)
+        except SXClusterNotFound:
+            pass
+    return len(sources) - (legacy_totals_name in sources)
+
+
+def _compact_due():
+    """Merge the batches of this host on every cluster, if no other
+    process did in the last `COMPACT_INTERVAL` seconds."""
+    with _compact_lock(blocking=False) as locked:
+        path = _state_path('compact.lock')
+        if not locked or \
+                time.time() - os.path.getmtime(path) < COMPACT_INTERVAL:
+            return
+        for cluster in get_clusters():
+            try:
+                with use_cluster(cluster):
+                    _compact(legacy=False)
+            except SXClusterNotFound:
+                pass  # No links on the cluster
+            except SXClientException as e:
+                logger.warning("Failed to merge link stats of cluster "
+                               "'{}': {}".format(cluster, e))
+        os.utime(path, None)
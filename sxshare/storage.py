@@ -0,0 +1,74 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+from __future__ import unicode_literals
+
+import gzip
+import os
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """Static files storage which adds content hashes to file names and
+    saves gzip (and, if the brotli package is installed, brotli) compressed
+    variants of text files next to them, for nginx's gzip_static and
+    brotli_static.
+    """
+    compressible_extensions = (
+        '.css', '.js', '.html', '.htm', '.svg', '.json', '.txt', '.xml',
+        '.ico', '.properties', '.map', '.ttf', '.otf', '.eot',
+    )
+    min_compress_size = 512
+
+    def hashed_name(self, name, content=None):
+        try:
+            return super(CompressedManifestStaticFilesStorage, self) \
+                .hashed_name(name, content)
+        except ValueError:
+            # A reference to a missing file, e.g. in vendored css; keep it
+            if content is not None or self.exists(name):
+                raise
+            return name
+
+    def post_process(self, paths, dry_run=False, **options):
+        processed = super(CompressedManifestStaticFilesStorage, self) \
+            .post_process(paths, dry_run=dry_run, **options)
+        for name, hashed_name, result in processed:
+            if not dry_run and not isinstance(result, Exception):
+                self.compress(name)
+                if hashed_name:
+                    self.compress(hashed_name)
+            yield name, hashed_name, result
+
+    def compress(self, name):
+        if not name.lower().endswith(self.compressible_extensions):
+            return
+        path = self.path(name)
+        with open(path, 'rb') as f:
+            content = f.read()
+        if len(content) < self.min_compress_size:
+            return
+
+        gzip_path = path + '.gz'
+        with open(gzip_path, 'wb') as raw:
+            # Fixed mtime, so that the output only depends on the content
+            with gzip.GzipFile(filename='', mode='wb', fileobj=raw,
+                               compresslevel=9, mtime=0) as f:
+                f.write(content)
+        self._drop_if_larger(gzip_path, len(content))
+
+        if brotli is not None:
+            brotli_path = path + '.br'
+            with open(brotli_path, 'wb') as f:
+                f.write(brotli.compress(content))
+            self._drop_if_larger(brotli_path, len(content))
+
+    def _drop_if_larger(self, path, size):
+        if os.path.getsize(path) >= size:
+            os.remove(path)
@@ -0,0 +1,179 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Bandwidth and concurrency limits for downloads.
+
+Limits are configured per link, per client IP and in total (the 'link',
+'client' and 'total' scopes) and are shared by all worker processes on this
+host, through small JSON files in `settings.THROTTLING_DIR` guarded by flock.
+
+Bandwidth is limited with token buckets holding up to one second worth of
+bytes. A stream takes bytes from its buckets before sending them and sleeps
+off any resulting debt, so a popular link slows down instead of hogging the
+cluster and the workers. Bytes are taken `BATCH_INTERVAL` seconds worth at
+a time (at the lowest rate) and spent from memory, so that the bucket file
+is locked a few times a second per stream rather than for every chunk.
+"""
+
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import json
+import os
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.conf import settings
+from sizefield.utils import parse_size
+
+
+SCOPES = ('link', 'client', 'total')
+BATCH_INTERVAL = 0.1
+
+
+def _parse_limits(limits, parse):
+    return {scope: parse(limits[scope])
+            for scope in SCOPES if limits.get(scope)}
+
+
+# Bytes per second, by scope
+rates = _parse_limits(settings.THROTTLING_RATE, parse_size)
+# Concurrent downloads, by scope
+caps = _parse_limits(settings.THROTTLING_CONCURRENCY, int)
+
+
+class LimitExceeded(Exception):
+    """Raised when a download would exceed a concurrency cap."""
+
+    def __init__(self, scope):
+        super(LimitExceeded, self).__init__(
+            "Too many concurrent downloads ({})".format(scope))
+        self.scope = scope
+        self.retry_after = settings.THROTTLING_RETRY_AFTER
+
+
+@contextmanager
+def shared_state(name):
+    """Lock and load a state file. Changes made to the yielded dict are
+    saved, unless an exception is raised."""
+    directory = settings.THROTTLING_DIR
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    path = os.path.join(directory, '{}.json'.format(name))
+    with open(path, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or '{}')
+            except ValueError:
+                state = {}
+            yield state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Download(object):
+    """A single download, subject to the limits of its link and client."""
+
+    def __init__(self, token, ip):
+        self.keys = {'link': token, 'client': ip or '', 'total': ''}
+        self.slot = None
+        self.allowance = 0  # Bytes taken from the buckets, not sent yet
+
+    def start(self):
+        """Reserve a slot in each capped scope, or raise LimitExceeded."""
+        if not caps:
+            return
+        pid = os.getpid()
+        with shared_state('slots') as slots:
+            for slot, data in slots.items():
+                if not _is_alive(data['pid']):  # Crashed worker
+                    del slots[slot]
+            for scope, cap in caps.items():
+                key = self.keys[scope]
+                count = sum(1 for data in slots.itervalues()
+                            if data[scope] == key)
+                if count >= cap:
+                    raise LimitExceeded(scope)
+            self.slot = '{}-{}'.format(pid, uuid4().hex)
+            slots[self.slot] = dict(self.keys, pid=pid)
+
+    def finish(self):
+        """Release the reserved slots. Safe to call more than once."""
+        if self.slot is None:
+            return
+        with shared_state('slots') as slots:
+            slots.pop(self.slot, None)
+        self.slot = None
+
+    def consume(self, size):
+        """Spend `size` bytes, taking a batch from the buckets (and sleeping
+        if they run out) once the previous one is spent."""
+        if not rates:
+            return
+        if size <= self.allowance:
+            self.allowance -= size
+            return
+        batch = max(size - self.allowance,
+                    int(min(rates.values()) * BATCH_INTERVAL))
+        self.allowance += batch - size
+        self._take(batch)
+
+    def _take(self, size):
+        now = time.time()
+        wait = 0
+        with shared_state('buckets') as buckets:
+            for scope, rate in rates.items():
+                name = '{}:{}'.format(scope, self.keys[scope])
+                tokens, updated = buckets.get(name, (rate, now))
+                tokens = min(rate, tokens + (now - updated) * rate) - size
+                buckets[name] = (tokens, now)
+                if tokens < 0:
+                    wait = max(wait, -tokens / rate)
+            for name, (tokens, updated) in buckets.items():
+                rate = rates.get(name.split(':', 1)[0])
+                if rate is None or tokens + (now - updated) * rate >= rate:
+                    del buckets[name]  # Full again, same as missing
+        if wait:
+            time.sleep(wait)
+
+
+class ThrottledStream(object):
+    """Response iterator which applies the limits of a started download
+    and releases its slots once closed."""
+
+    def __init__(self, iterator, download):
+        self.iterator = iterator
+        self.download = download
+
+    def __iter__(self):
+        try:
+            for chunk in self.iterator:
+                self.download.consume(len(chunk))
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        self.download.finish()
+        close = getattr(self.iterator, 'close', None)
+        if close is not None:
+            close()
@@ -0,0 +1,304 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Rejecting requests for unknown links without querying the cluster.
+
+Every worker process remembers missing and expired tokens for
+`settings.LINKS_NEGATIVE_CACHE_TTL` seconds.
+
+With `settings.LINKS_FILTER_ENABLED`, a Bloom filter of all the tokens on the
+share links volume is rebuilt every `settings.LINKS_FILTER_INTERVAL` seconds
+by one process on the host, and loaded from `settings.STATE_DIR` by all of
+them. A token missing from the filter doesn't exist, unless it was created
+after the filter was built. Tokens start with a stamp of the minute they
+were created in (see `stamp`), so new tokens can be told from the random
+ones of scanners, which are rejected - but for the few whose stamp happens
+to be recent.
+
+Tokens created by older versions have no stamp: they are told apart by
+their length (12 characters before the slash, rather than 14), and are
+always treated as old. Enable the filter once all workers are upgraded, so
+that every new token is stamped.
+"""
+
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import hashlib
+import json
+import math
+import os
+import string
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from sxclient.exceptions import SXClientException
+
+from . import api, journal, logger, metrics
+
+
+ALPHABET = string.ascii_letters + string.digits
+STAMP_PERIOD = len(ALPHABET) ** 2  # minutes
+# Characters before the slash of stamped tokens: the stamp and 12 random ones
+STAMPED_LENGTH = 2 + 12
+# Seconds between checks for a new filter
+CHECK_INTERVAL = 10
+# Allowed clock skew between the hosts, plus the stamp precision
+FILTER_MARGIN = 120
+FALSE_POSITIVE_RATE = 0.01
+# Smaller filters would have more false positives
+MIN_CAPACITY = 1000
+# Files per listing request, when rebuilding a filter
+LIST_PAGE_SIZE = 1000
+
+
+def stamp(now=None):
+    """Return the stamp of new tokens, two characters encoding the current
+    minute (modulo `STAMP_PERIOD`)."""
+    minute = int((now or time.time()) // 60) % STAMP_PERIOD
+    return ALPHABET[minute // len(ALPHABET)] + ALPHABET[minute % len(ALPHABET)]
+
+
+def stamp_age(token, now=None):
+    """Return the seconds since a token was created according to its stamp
+    (modulo the stamp period), or None if it isn't stamped."""
+    if len(token.split('/', 1)[0]) != STAMPED_LENGTH:
+        return None
+    try:
+        minute = ALPHABET.index(token[0]) * len(ALPHABET) + \
+            ALPHABET.index(token[1])
+    except ValueError:
+        return None
+    current = int((now or time.time()) // 60)
+    return (current - minute) % STAMP_PERIOD * 60
+
+
+class NegativeCache(object):
+    """Keys remembered for `settings.LINKS_NEGATIVE_CACHE_TTL` seconds, up
+    to `settings.LINKS_NEGATIVE_CACHE_SIZE` of them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key: expiration time
+
+    def add(self, key):
+        ttl = settings.LINKS_NEGATIVE_CACHE_TTL
+        if not ttl:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = time.time() + ttl
+            while len(self.entries) > settings.LINKS_NEGATIVE_CACHE_SIZE:
+                self.entries.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self.entries[key]
+                return False
+            return True
+
+
+class BloomFilter(object):
+    """Set of strings with false positives, but no false negatives."""
+
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data or (bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, count, rate=FALSE_POSITIVE_RATE):
+        count = max(count, MIN_CAPACITY)
+        bits = int(math.ceil(-count * math.log(rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(float(bits) / count * math.log(2))))
+        return cls(bits, hashes)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack(b'<QQ', hashlib.md5(key).digest())
+        return ((h1 + i * h2) % self.bits for i in xrange(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.data[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, key):
+        return all(self.data[position // 8] & 1 << (position % 8)
+                   for position in self._positions(key))
+
+
+class Filters(object):
+    """Keeps the filters of all clusters up to date, in a background thread
+    of every process."""
+
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+        self.filters = {}  # cluster: (file mtime, built, BloomFilter)
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            thread = threading.Thread(target=self.run,
+                                      name='sxshare-token-filter')
+            thread.daemon = True
+            thread.start()
+
+    def run(self):
+        pid = self.pid
+        while pid == os.getpid():
+            for name in api.get_clusters():
+                try:
+                    self.refresh(name)
+                except Exception as e:
+                    logger.warning("Failed to update the token filter of "
+                                   "cluster '{}': {}".format(name, e))
+            time.sleep(CHECK_INTERVAL)
+
+    def refresh(self, name):
+        """Load the filter of a cluster, rebuilding it first if it's due
+        and no other process is rebuilding it."""
+        path = _filter_path(name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        if mtime is None or \
+                time.time() - mtime >= settings.LINKS_FILTER_INTERVAL:
+            if _rebuild(name, path):
+                mtime = os.path.getmtime(path)
+        current = self.filters.get(name)
+        if mtime is not None and (current is None or current[0] != mtime):
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                bloom = BloomFilter(header['bits'], header['hashes'],
+                                    f.read())
+            self.filters[name] = (mtime, header['built'], bloom)
+
+    def is_missing(self, name, token):
+        entry = self.filters.get(name)
+        if entry is None:
+            return False
+        _, built, bloom = entry
+        now = time.time()
+        if now - built > settings.LINKS_FILTER_INTERVAL * 2 + FILTER_MARGIN:
+            return False  # Not rebuilt lately
+        if token in bloom:
+            return False
+        age = stamp_age(token, now)
+        return age is None or age > now - built + FILTER_MARGIN
+
+
+def _filter_path(name):
+    return os.path.join(settings.STATE_DIR, 'links', '{}.filter'.format(name))
+
+
+def _rebuild(name, path):
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    with open(path + '.lock', 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False  # Being rebuilt by another process
+            raise
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = 0
+        if time.time() - mtime < settings.LINKS_FILTER_INTERVAL:
+            return False  # Just rebuilt by another process
+
+        built = time.time()
+        try:
+            with api.use_cluster(name):
+                tokens = _list_tokens()
+        except SXClientException as e:
+            logger.warning("Failed to list the links of cluster '{}': {}"
+                           .format(name, e))
+            return False
+        bloom = BloomFilter.for_capacity(len(tokens))
+        for token in tokens:
+            bloom.add(token)
+        header = json.dumps(
+            {'built': built, 'bits': bloom.bits, 'hashes': bloom.hashes})
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(header.encode('utf-8') + b'\n')
+            f.write(bloom.data)
+        os.rename(tmp_path, path)
+        return True
+
+
+def _list_tokens():
+    from sxshare import core, stats  # core imports us
+    core.ensure_share_links_volume()
+    other = tuple('{}/'.format(name) for name in
+                  (core.notify_dir, core.index_dir, core.uploads_dir,
+                   stats.stats_dir))
+    tokens = []
+    after = None
+    while True:
+        # Paged like `core.SharedFile.list_files_page`
+        params = {'recursive': True, 'limit': str(LIST_PAGE_SIZE)}
+        if after is not None:
+            params['after'] = after
+        names = sorted(api.sx.listFiles.json_call(
+            core.share_links_volname, **params)['fileList'])
+        tokens.extend(name.lstrip('/') for name in names
+                      if not name.lstrip('/').startswith(other))
+        if len(names) < LIST_PAGE_SIZE:
+            return tokens
+        after = names[-1]
+
+
+_missing = NegativeCache()
+_filters = Filters()
+
+
+def is_unknown(token):
+    """Return True if the token surely doesn't exist (or has expired)."""
+    cached = (api.current_cluster(), token) in _missing
+    metrics.cache_lookup('missing_tokens', cached)
+    if cached:
+        metrics.rejected_tokens.inc(reason='cached')
+        return True
+    if settings.LINKS_FILTER_ENABLED:
+        _filters.start()
+        if _filters.is_missing(api.current_cluster(), token) and \
+                journal.get(token) is None:
+            metrics.rejected_tokens.inc(reason='filtered')
+            return True
+    return False
+
+
+def remember_missing(token):
+    """Remember that the token doesn't exist, or has expired.
+
+    With `settings.LINKS_WRITE_BEHIND`, recent tokens may exist in the
+    journal of another host, so they aren't remembered until they are
+    older than `journal.FLUSH_WINDOW`.
+    """
+    if settings.LINKS_WRITE_BEHIND:
+        age = stamp_age(token)
+        if age is not None and age <= journal.FLUSH_WINDOW + FILTER_MARGIN:
+            return
+    _missing.add((api.current_cluster(), token))
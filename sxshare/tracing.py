@@ -0,0 +1,205 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Per-request tracing of SX calls and sampled profiling.
+
+While a request is being traced, every query made through an instrumented
+SXController (see `api.instrument`) is recorded, together with the span it
+was made in. Requests slower than `settings.TRACING_SLOW_THRESHOLD` are
+logged as a single JSON document to the 'sxshare.trace' logger.
+
+Profiling is toggled at runtime with the `profiling` management command,
+which writes a control file shared by all worker processes. Sampled requests
+are dumped to `settings.PROFILING_DIR` in the pstats format.
+"""
+
+from __future__ import unicode_literals
+
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+logger = logging.getLogger('sxshare.trace')
+
+CONTROL_CHECK_INTERVAL = 1  # seconds
+
+_local = threading.local()
+
+
+class Trace(object):
+    """Calls and spans recorded for a single request."""
+
+    def __init__(self, request):
+        self.method = request.method
+        self.path = request.path
+        self.start = time.time()
+        self.view = None
+        self.calls = []
+        self.spans = []
+        self.current_span = None
+        self.profiler = None
+
+    @property
+    def duration(self):
+        return time.time() - self.start
+
+    def as_dict(self, status=None):
+        return {
+            'method': self.method,
+            'path': self.path,
+            'view': self.view,
+            'status': status,
+            'duration': round(self.duration, 6),
+            'sx_time': round(sum(c['duration'] for c in self.calls), 6),
+            'spans': self.spans,
+            'calls': self.calls,
+        }
+
+
+def get_current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def set_current_trace(trace):
+    """Attach a trace to the current thread, e.g. a worker thread making
+    SX calls on behalf of a request."""
+    _local.trace = trace
+
+
+def start_trace(request):
+    _local.trace = Trace(request)
+    return _local.trace
+
+
+def end_trace():
+    trace = get_current_trace()
+    _local.trace = None
+    return trace
+
+
+def record_call(method, node, duration, sent=0, received=0, status='ok'):
+    """Add an SX call to the trace of the current request, if any."""
+    trace = get_current_trace()
+    if trace is None:
+        return
+    trace.calls.append({
+        'method': method,
+        'node': node,
+        'span': trace.current_span,
+        'offset': round(time.time() - duration - trace.start, 6),
+        'duration': round(duration, 6),
+        'sent': sent,
+        'received': received,
+        'status': status,
+    })
+
+
+@contextmanager
+def span(name):
+    """Time a part of the request, e.g. `with span('token_read'): ...`."""
+    trace = get_current_trace()
+    if trace is None:
+        yield
+        return
+    parent, trace.current_span = trace.current_span, name
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace.current_span = parent
+        trace.spans.append({
+            'name': name,
+            'parent': parent,
+            'offset': round(start - trace.start, 6),
+            'duration': round(time.time() - start, 6),
+        })
+
+
+def log_if_slow(trace, status=None):
+    threshold = settings.TRACING_SLOW_THRESHOLD
+    if threshold is not None and trace.duration >= threshold:
+        logger.warning(json.dumps(trace.as_dict(status), sort_keys=True))
+
+
+# Profiling
+
+class ProfilingControl(object):
+    """Runtime profiling settings, shared through a control file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.rate = 0
+        self.until = None
+        self._mtime = None
+        self._checked = 0
+
+    def refresh(self):
+        now = time.time()
+        if now - self._checked < CONTROL_CHECK_INTERVAL:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self.rate, self.until, self._mtime = 0, None, None
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.rate = float(data.get('rate', 0))
+            self.until = data.get('until')
+        except (IOError, ValueError, TypeError):
+            self.rate, self.until = 0, None
+
+    def update(self, rate, duration=None):
+        """Enable profiling of a fraction of requests; 0 disables it."""
+        data = {'rate': rate}
+        if duration:
+            data['until'] = time.time() + duration
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_path, self.path)
+
+    def should_profile(self):
+        self.refresh()
+        if not self.rate:
+            return False
+        if self.until is not None and time.time() > self.until:
+            return False
+        return random.random() < self.rate
+
+
+profiling = ProfilingControl(
+    os.path.join(settings.STATE_DIR, 'profiling.json'))
+
+
+def dump_profile(profiler, trace):
+    directory = settings.PROFILING_DIR
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = '{:.3f}-{}-{}.prof'.format(
+        trace.start, trace.view or 'unresolved', os.getpid())
+    path = os.path.join(directory, name)
+    profiler.dump_stats(path)
+    return path
+
+
+def new_profiler():
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
@@ -0,0 +1,197 @@
+# Copyright (C) 2015-2016 Skylable Ltd. <info-copyright@skylable.com>
+# License: MIT, see LICENSE for more details.
+
+"""Uploads of files through upload links.
+
+Request bodies are streamed to the cluster as they are read: every batch of
+blocks (4 MB) is sent to its nodes in the background while the next one is
+read, by `ParallelUploader`. At most `settings.UPLOAD_PARALLEL_REQUESTS`
+block requests are in flight, which bounds the memory an upload takes,
+however big the file is. They're sent by threads of their own (at most
+`settings.UPLOAD_THREADS` per process), so that uploads don't hold up the
+block fetches of downloads.
+
+Every upload is recorded by a marker on the share links volume
+(`uploads/<link hash>/<time>.<size>.<random>`), so the quotas of a link are
+checked with a single listing. Markers are created before the upload, so
+concurrent uploads count against the quota, and deleted if it fails.
+Uploads to different hosts at the same moment may still exceed the quota
+by a file.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import time
+from io import BytesIO
+from Queue import Empty, Queue
+
+from django.conf import settings
+from django.utils.crypto import get_random_string
+from sxclient import SXFileUploader
+from sxclient.exceptions import (
+    SXClientException, SXClusterNotFound, SXClusterRequestTimeout)
+
+from sxshare import core, tracing
+from sxshare.api import get_client, sx, uploader
+from sxshare.download import Executor
+
+
+# Seconds to wait for a block request, including the time it waits for a
+# thread
+REQUEST_TIMEOUT = 300
+
+
+class UploadError(Exception):
+    """The upload was rejected, see the subclasses."""
+
+
+class InvalidName(UploadError):
+    pass
+
+
+class FileExists(UploadError):
+    pass
+
+
+class QuotaExceeded(UploadError):
+    pass
+
+
+class ParallelUploader(SXFileUploader):
+    """SXFileUploader which sends the blocks of a batch to their nodes at
+    once, in the background while the next batch is read."""
+
+    def _create_blocks(self, context, blocks):
+        if getattr(context, 'results', None) is None:
+            context.results = Queue()
+            context.pending = 0
+        contents = {}
+        block_dict = dict(blocks)
+        for block_hash, nodes in context.upload_data.iteritems():
+            contents.setdefault(nodes[0], []).append(block_dict[block_hash])
+
+        trace = tracing.get_current_trace()
+        for node, node_blocks in contents.iteritems():
+            context.pending += 1
+            _executor.submit(
+                self._create_on_node, context.results, trace, node,
+                context.block_size, context.token, b''.join(node_blocks))
+            context.number_of_requests += 1
+        context.uploaded_blocks += len(blocks)
+        self._wait(context, settings.UPLOAD_PARALLEL_REQUESTS)
+
+    def _create_on_node(self, results, trace, node, block_size, token,
+                        content):
+        tracing.set_current_trace(trace)
+        # Every request puts exactly one result, or the upload would wait
+        # for it forever
+        try:
+            self._sxcontroller.createBlocks.call_on_node(
+                node, block_size, token, content)
+        except SXClientException as e:
+            results.put(e)
+        except Exception as e:  # Not wrapped by sxclient, e.g. timeouts
+            results.put(SXClientException(
+                "Failed to upload blocks to {}: {!r}".format(node, e)))
+        else:
+            results.put(None)
+        finally:
+            tracing.set_current_trace(None)
+
+    def _wait(self, context, limit):
+        while context.pending > limit:
+            try:
+                error = context.results.get(timeout=REQUEST_TIMEOUT)
+            except Empty:
+                raise SXClusterRequestTimeout(
+                    "Timed out uploading blocks")
+            context.pending -= 1
+            if error is not None:
+                raise error
+
+    def _flush(self, context):
+        if getattr(context, 'results', None) is not None:
+            self._wait(context, 0)
+        super(ParallelUploader, self)._flush(context)
+
+
+_executor = Executor('sxshare-upload', settings.UPLOAD_THREADS)
+
+
+def _markers_dir(token):
+    if isinstance(token, unicode):
+        token = token.encode('utf-8')
+    return '{}/{}/'.format(core.uploads_dir, hashlib.sha1(token).hexdigest())
+
+
+def _list_markers(token):
+    try:
+        return sx.listFiles.json_call(
+            core.share_links_volname, _markers_dir(token))['fileList']
+    except SXClusterNotFound:
+        return {}
+
+
+def get_usage(token):
+    """Return the number and the total size of the files uploaded through a
+    link."""
+    # Markers are named <time>.<size>.<random>
+    sizes = [int(name.rsplit('/', 1)[-1].split('.')[1])
+             for name in _list_markers(token)]
+    return len(sizes), sum(sizes)
+
+
+def delete_markers(token):
+    """Delete the upload markers of a link, e.g. when it has expired."""
+    for name in _list_markers(token):
+        try:
+            sx.deleteFile.json_call(core.share_links_volname, name)
+        except SXClusterNotFound:
+            pass
+
+
+def clean_name(name):
+    """Return the name of an uploaded file, or raise InvalidName."""
+    name = name.strip()
+    if not name or name.startswith('.') or len(name.encode('utf-8')) > 255 \
+            or any(c in name for c in '/\\*?[]') or \
+            any(ord(c) < 32 for c in name):
+        raise InvalidName("Invalid file name: {}".format(name))
+    return name
+
+
+def upload_file(file, token, name, size, stream):
+    """Upload a file of `size` bytes, read from `stream`, to the directory
+    of an upload link.
+
+    Raises an UploadError if the name is invalid, the file exists or the
+    quota of the link is exceeded.
+    """
+    name = clean_name(name)
+    path = (file.path.rstrip(b'/') + b'/' + name.encode('utf-8')).lstrip(b'/')
+    limits = file.upload
+    count, total = get_usage(token)
+    if limits.get('max_files') and count + 1 > limits['max_files']:
+        raise QuotaExceeded("No more files can be uploaded.")
+    if limits.get('max_size') and total + size > limits['max_size']:
+        raise QuotaExceeded("The file is too big.")
+    files = sx.listFiles.json_call(
+        file.volume, core.escape_pattern(path))['fileList']
+    if '/' + path.decode('utf-8') in files:
+        raise FileExists("The file already exists.")
+
+    marker = '{}{}.{}.{}'.format(
+        _markers_dir(token), int(time.time()), size, get_random_string())
+    uploader.upload_stream(
+        core.share_links_volname, 0, marker, BytesIO(b''))
+    try:
+        with tracing.span('upload'):
+            ParallelUploader(get_client().sx).upload_stream(
+                file.volume, size, path, stream)
+    except Exception:
+        try:
+            sx.deleteFile.json_call(core.share_links_volname, marker)
+        except SXClientException:
+            pass
+        raise
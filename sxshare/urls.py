@@ -8,6 +8,10 @@ import views
 
 _urlpatterns = [
     url(r'^api/share/?$', views.ShareFileApi, translations=False),
+    url(r'^metrics/?$', views.MetricsView, translations=False),
+    url(r'^api/stats/?$', views.LinkStatsView, translations=False),
+    url(r'^health/?$', views.HealthView, translations=False),
+    url(r'^ready/?$', views.ReadyView, translations=False),
 
     url(r'^(?P<token>[^/]+/[^/]+)/?$', views.SharedRelay),
     url(r'^(?P<token>[^/]+/[^/]+)/(?P<path>.+)$', views.SharedRelay),
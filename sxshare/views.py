@@ -3,24 +3,42 @@
 
 from __future__ import unicode_literals
 
+import hashlib
 import json
+import re
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from mimetypes import guess_type
+from time import time
 from urllib import quote
 
+from django.conf import settings
 from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
-from django.http import JsonResponse, StreamingHttpResponse
+from django.http import (
+    Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified,
+    JsonResponse, StreamingHttpResponse)
 from django.shortcuts import redirect, render
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.functional import cached_property
+from django.utils.http import http_date, parse_http_date_safe
 from django.views import generic
 from ipware.ip import get_ip
 from sxclient.exceptions import SXClusterNotFound, SXClientException
 
+import admission
+import archive
+import compression
 import core
+import filters
 import forms
-from . import logger
+import offload
+import stats
+import throttling
+import tokens
+import upload
+from . import logger, metrics
 from .api import sx
-from utils import TimeoutError
+from utils import TimeoutError, timeout
 
 
 class ShareFileApi(generic.edit.BaseFormView):
@@ -49,10 +67,24 @@ class ShareFileApi(generic.edit.BaseFormView):
 
     def form_valid(self, form):
         data = form.cleaned_data
-        token = core.share_file(data['path'],
-                                expiration=data.get('expire_time'),
-                                password=data.get('password'),
-                                email=data.get('notify'))
+        # Keys are chosen by the clients, so they're scoped to a user
+        key = self.request.META.get('HTTP_IDEMPOTENCY_KEY') or \
+            data.get('idempotency_key')
+        if key:
+            key = '{}:{}'.format(data['access_key'], key)
+        limits = None
+        if data.get('upload'):
+            limits = {'max_size': data.get('max_size'),
+                      'max_files': data.get('max_files')}
+        try:
+            token = core.share_file(data['path'],
+                                    expiration=data.get('expire_time'),
+                                    password=data.get('password'),
+                                    email=data.get('notify'),
+                                    idempotency_key=key or None,
+                                    upload=limits)
+        except core.IdempotencyConflict as e:
+            return self.fail(e.message)
         return self.succeed(token)
 
     def form_invalid(self, form):
@@ -105,10 +137,16 @@ class SharedRelay(generic.View):
 
     def dispatch(self, *args, **kwargs):
         token = self.kwargs['token']
+        if tokens.is_unknown(token):
+            return render(self.request, self.template_name_missing)
         file = core.get_shared_file_info(token)
         if file is None or file.is_expired or not file.exists():
+            tokens.remember_missing(token)
             return render(self.request, self.template_name_missing)
-        view = SharedDirView if file.is_dir else SharedFileView
+        if file.is_upload:
+            view = SharedUploadView
+        else:
+            view = SharedDirView if file.is_dir else SharedFileView
         return view.as_view(file=file)(*args, **kwargs)
 
 
@@ -154,12 +192,23 @@ class SharedFileView(FileBase):
             headless = 'mozilla' not in self.request.META \
                 .get('HTTP_USER_AGENT', '').lower()
             explicit_download = 'download' in self.request.GET
+            if 'preview' in self.request.GET and \
+                    self.file.sxweb_type == 'archive':
+                return archive_response(self.request, self.file)
             if headless or explicit_download:
-                return self.serve_file()
-        return super(SharedFileView, self).get(*args, **kwargs)
+                response = self.serve_file()
+                patch_vary_headers(response, ['User-Agent'])
+                return response
+        response = super(SharedFileView, self).get(*args, **kwargs)
+        # The same url serves the file to headless clients
+        patch_vary_headers(response, ['User-Agent'])
+        return response
 
     def form_valid(self, form):
         self.authenticate(form)
+        if settings.DOWNLOAD_OFFLOAD:
+            # nginx can only send the file for a GET request
+            return redirect(self.request.path + '?download')
         return self.serve_file()
 
     def serve_file(self):
@@ -168,6 +217,53 @@ class SharedFileView(FileBase):
             self.request, self.file, self.kwargs['token'], client_ip)
 
 
+class SharedUploadView(FileBase):
+    """Receives files through an upload link.
+
+    Files are sent as raw request bodies, `PUT <link url>/<file name>`,
+    and streamed to the cluster while they are read, see the upload module.
+    """
+    template_name = 'upload.html'
+    http_method_names = ['get', 'post', 'put', 'head', 'options']
+
+    def get(self, *args, **kwargs):
+        if self.kwargs.get('path'):
+            return redirect(SharedRelay.url_name, token=self.kwargs['token'])
+        return super(SharedUploadView, self).get(*args, **kwargs)
+
+    def form_valid(self, form):
+        self.authenticate(form)
+        return redirect(self.request.get_full_path())
+
+    def put(self, *args, **kwargs):
+        if not self.is_authenticated:
+            return JsonResponse({'error': "Password required."}, status=403)
+        try:
+            size = int(self.request.META['CONTENT_LENGTH'])
+        except (KeyError, ValueError):
+            return JsonResponse({'error': "Content-Length required."},
+                                status=411)
+        try:
+            admission.admit_bulk(self.request)
+        except admission.Overloaded as e:
+            return admission.overloaded_response(e)
+        try:
+            # The body is read from the request, never loaded whole
+            upload.upload_file(self.file, self.kwargs['token'],
+                               self.kwargs.get('path', ''), size,
+                               self.request)
+        except upload.InvalidName as e:
+            return JsonResponse({'error': e.message}, status=400)
+        except upload.FileExists as e:
+            return JsonResponse({'error': e.message}, status=409)
+        except upload.QuotaExceeded as e:
+            return JsonResponse({'error': e.message}, status=413)
+        except SXClientException as e:
+            logger.error("Upload failed: {}".format(e))
+            return JsonResponse({'error': "Upload failed."}, status=502)
+        return JsonResponse({'status': True}, status=201)
+
+
 class PaginationMixin(object):
     """Mixin for applying pagination to a list of objects."""
     page_size = 20
@@ -221,9 +317,17 @@ class SharedDirView(PaginationMixin, FileBase):
         return super(SharedDirView, self).dispatch(*args, **kwargs)
 
     def get(self, *args, **kwargs):
+        if self.request.GET.get('format') == 'json':
+            if self.query:
+                return self.json_search()
+            return self.json_listing()
         if not core.is_dir(self.request.path):
             try:
                 # Is it a file?
+                if 'preview' in self.request.GET and \
+                        core.get_sxweb_type(self.path) == 'archive':
+                    return archive_response(
+                        self.request, self.file, self.path)
                 client_ip = get_ip(self.request)
                 return download_response(
                     self.request, self.file, self.kwargs['token'], client_ip,
@@ -243,9 +347,114 @@ class SharedDirView(PaginationMixin, FileBase):
         return redirect(self.request.get_full_path())
 
     def get_pagination_source(self):
+        if self.query:
+            return self.search_results
         return self.file.list_files(self.path)
 
+    @cached_property
+    def query(self):
+        return self.request.GET.get('q', '').strip()
+
+    @cached_property
+    def search_results(self):
+        if '/' in self.query:
+            return []
+        return list(self.file.search(
+            self.query, self.kwargs.get('path', ''),
+            limit=settings.SEARCH_MAX_RESULTS))
+
+    @cached_property
+    def base_url(self):
+        url = self.request.build_absolute_uri(self.request.path)
+        if not core.is_dir(url):
+            url += '/'
+        return url
+
+    def file_json(self, file):
+        return {
+            'name': file.name,
+            'type': 'dir' if file.is_dir else 'file',
+            'size': file.size,
+            'created_at': file.creation_date and
+            file.creation_date.isoformat() + 'Z',
+            'url': self.base_url + quote(file.name.encode('utf-8')),
+        }
+
+    def json_listing(self):
+        """Directory listing for machine clients, paged with a cursor.
+
+        Accepts `limit`, `cursor` (from the previous page) and `recursive`
+        query parameters.
+        """
+        if not self.is_authenticated:
+            return JsonResponse({'error': "Password required."}, status=403)
+        params = self.request.GET
+        try:
+            limit = int(params.get('limit', settings.LISTING_PAGE_SIZE))
+            limit = sorted([1, limit, settings.LISTING_MAX_PAGE_SIZE])[1]
+            after = params.get('cursor')
+            if after is not None:
+                after = urlsafe_b64decode(after.encode('ascii')) \
+                    .decode('utf-8')
+        except (ValueError, TypeError):
+            return JsonResponse({'error': "Invalid limit or cursor."},
+                                status=400)
+        recursive = params.get('recursive') in ('1', 'true')
+
+        files, last = self.file.list_files_page(
+            self.path, limit=limit, after=after, recursive=recursive)
+
+        cursor = next_url = None
+        if last is not None:
+            cursor = urlsafe_b64encode(last.encode('utf-8'))
+            query = params.copy()
+            query['cursor'] = cursor
+            next_url = '{}?{}'.format(self.base_url, query.urlencode())
+        return JsonResponse({
+            'path': self.full_path,
+            'files': [self.file_json(f) for f in files],
+            'cursor': cursor,
+            'next': next_url,
+        })
+
+    def json_search(self):
+        """Stream files with names matching the `q` query parameter, one
+        JSON document per line, followed by a summary line.
+        """
+        if not self.is_authenticated:
+            return JsonResponse({'error': "Password required."}, status=403)
+        if '/' in self.query:
+            return JsonResponse(
+                {'error': "Search pattern can't contain slashes."},
+                status=400)
+        try:
+            admission.admit_bulk(self.request)
+        except admission.Overloaded as e:
+            return admission.overloaded_response(e)
+        limit = settings.SEARCH_MAX_RESULTS
+        files = self.file.search(
+            self.query, self.kwargs.get('path', ''), limit=limit)
+
+        def lines():
+            count = 0
+            try:
+                for file in files:
+                    count += 1
+                    yield json.dumps(self.file_json(file)) + '\n'
+            except SXClientException as e:
+                logger.error("Search failed: {}".format(e))
+                yield json.dumps({'error': "Search failed."}) + '\n'
+                return
+            yield json.dumps({'done': True, 'count': count,
+                              'truncated': count >= limit}) + '\n'
+        return StreamingHttpResponse(
+            lines(), content_type='application/x-ndjson')
+
     def get_context_data(self, **kwargs):
+        if self.query:
+            kwargs['query'] = self.query
+            kwargs['search_truncated'] = \
+                len(self.search_results) >= settings.SEARCH_MAX_RESULTS
         return super(SharedDirView, self).get_context_data(
             is_subdir=bool(self.path), path=self.full_path, **kwargs)
 
@@ -263,25 +472,251 @@ class SharedDirView(PaginationMixin, FileBase):
 
 
 def download_response(request, file, token, ip=None, path=''):
-    """Util for streaming a shared file."""
+    """Util for streaming a shared file.
+
+    HEAD, conditional (If-None-Match, If-Modified-Since) and single range
+    requests are supported. Headers come from the file's listing entry, so
+    HEAD and 304 responses don't fetch any blocks or create download
+    markers.
+
+    With `settings.DOWNLOAD_OFFLOAD`, whole files are sent by nginx, see
+    the offload module.
+
+    Files on volumes with filters are decoded while they are sent, always
+    whole and without Content-Length: the listing describes their filtered
+    representation, see the filters module.
+    """
+    try:
+        volume_filter = file.volume_filter
+    except filters.UnsupportedFilter as e:
+        # Links created before the filter was rejected
+        return HttpResponse(e.message, content_type='text/plain', status=501)
+    info = file.get_info(path)
+    size = info['fileSize']
+    # Parts of a download sent by nginx, which are concatenated as they are
+    manifest = offload.is_manifest_request(request) and not volume_filter
+    part_range = None if volume_filter else offload.get_range(request, size)
     if path:
         filename = core.get_filename(path)
     else:
         filename = file.filename
-    if file.notify_email:
-        core.create_download_marker(
-            file, token, ip, path,
-            user_agent=request.META.get('HTTP_USER_AGENT', ''))
-
     full_path = file.get_path(path)
     content_type = guess_type(full_path)[0]
     if content_type is None:
         content_type = 'application/octet-stream'
+    compressible = compression.is_compressible(full_path)
+    encoding = compressible and not (manifest or part_range) and \
+        compression.choose_encoding(request)
+    etag = get_etag(info, encoding)
+    last_modified = info.get('createdAt')
+
+    def set_headers(response):
+        if etag:
+            response['ETag'] = etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        response['Accept-Ranges'] = 'none' if volume_filter else 'bytes'
+        if encoding:
+            response['Content-Encoding'] = encoding
+        if compressible:
+            patch_vary_headers(response, ['Accept-Encoding'])
+        set_content_disposition_header(response, filename)
+        set_cache_headers(response, file)
+        return response
+
+    if not part_range and is_not_modified(request, etag, last_modified):
+        return set_headers(HttpResponseNotModified())
+    if manifest:
+        response = set_headers(HttpResponse(
+            offload.get_manifest(request, file.volume, full_path),
+            content_type=content_type))
+        response['Accept-Ranges'] = 'none'
+        return response
+    try:
+        if volume_filter:
+            byte_range = None  # Offsets are only known once decoded
+        else:
+            byte_range = part_range or \
+                get_range(request, size, etag, last_modified)
+    except RangeNotSatisfiable:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+    start, end = byte_range or (0, size)
+
+    if request.method == 'HEAD':
+        content = None
+    elif offload.can_offload(request, size, byte_range, encoding,
+                             volume_filter):
+        # Not throttled, nginx limits can be used instead
+        if file.notify_email:
+            core.create_download_marker(
+                file, token, ip, path,
+                user_agent=request.META.get('HTTP_USER_AGENT', ''))
+        stats.count_download(token, size)
+        metrics.offloaded_bytes.inc(size)
+        return set_headers(offload.redirect_response(request))
+    elif part_range:
+        # Parts of offloaded downloads, which were admitted and counted
+        # already; they can't be refused halfway
+        content = metrics.track_stream(file.get_downloader(path, start, end))
+    else:
+        try:
+            admission.admit_bulk(request)
+        except admission.Overloaded as e:
+            return admission.overloaded_response(e)
+        download = throttling.Download(token, ip)
+        try:
+            download.start()
+        except throttling.LimitExceeded as e:
+            return throttled_response(e)
+
+        try:
+            # Later ranges are continuations, e.g. by download managers
+            new_download = start == 0
+            if file.notify_email and new_download:
+                core.create_download_marker(
+                    file, token, ip, path,
+                    user_agent=request.META.get('HTTP_USER_AGENT', ''))
+            content = file.get_downloader(path, start, end)
+            if encoding:
+                content = compression.compress_stream(content, encoding)
+            iterator = stats.track_download(
+                token, metrics.track_stream(content), count=new_download)
+            content = throttling.ThrottledStream(iterator, download)
+        except Exception:
+            download.finish()
+            raise
+
+    if content is None:
+        response = HttpResponse(content_type=content_type)
+    else:
+        response = StreamingHttpResponse(content, content_type=content_type)
+    if byte_range and not part_range:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(
+            start, end - 1, size)
+    if not encoding and not volume_filter:
+        # Lets the server send the response without chunked encoding
+        response['Content-Length'] = end - start
+    return set_headers(response)
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+range_re = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_range(request, size, etag, last_modified):
+    """Return the requested byte range as (start, end), end exclusive, or
+    None if the whole file should be sent.
+
+    Invalid and multiple ranges are ignored, as are ranges of a different
+    version of the file (see If-Range).
+    """
+    header = request.META.get('HTTP_RANGE')
+    if not header:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag and \
+            parse_http_date_safe(if_range) != last_modified:
+        return None
+    match = range_re.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:  # The last bytes
+        if not int(last) or not size:
+            raise RangeNotSatisfiable()
+        return max(0, size - int(last)), size
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    end = min(size, int(last) + 1) if last else size
+    return start, end
+
+
+def get_etag(info, encoding=None):
+    """Strong ETag of a file revision, different for each encoding."""
+    revision = info.get('fileRevision')
+    if not revision:
+        return None
+    tag = hashlib.md5(revision.encode('utf-8')).hexdigest()
+    if encoding:
+        tag += '-' + encoding
+    return '"{}"'.format(tag)
+
+
+def is_not_modified(request, etag, last_modified):
+    """Whether the client's copy is up to date, see If-None-Match and
+    If-Modified-Since."""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        if not etag:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak comparison
+        return '*' in tags or etag in (
+            tag[2:] if tag.startswith('W/') else tag for tag in tags)
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return bool(if_modified_since and last_modified and
+                last_modified <= if_modified_since)
+
+
+def archive_response(request, file, path=''):
+    """Render the member list of an archive, for previews.
+
+    Raises SXClusterNotFound if there is no such file.
+    """
+    context = {}
+    try:
+        context['members'], context['complete'] = archive.list_members(
+            file.volume, file.get_path(path))
+    except (archive.ArchiveError, filters.UnsupportedFilter) as e:
+        logger.info("Can't list archive {}: {}".format(
+            file.get_path(path), e))
+        context['invalid'] = True
+    except SXClusterNotFound:
+        raise
+    except SXClientException as e:
+        logger.error("Archive listing failed: {}".format(e))
+        context['failed'] = True
+        # Not cached, the next attempt may succeed
+        return render(request, '_archive.html', context, status=502)
+    response = render(request, '_archive.html', context)
+    set_cache_headers(response, file)
+    return response
 
-    response = StreamingHttpResponse(
-        file.get_downloader(path),
-        content_type=content_type)
-    set_content_disposition_header(response, filename)
+
+def set_cache_headers(response, file):
+    """Let shared caches keep downloads of public links until they expire.
+
+    Downloads of password protected links and links with notifications
+    must never be served from a cache.
+    """
+    if file.password or file.notify_email:
+        patch_cache_control(response, private=True, no_store=True)
+        return
+    max_age = settings.PUBLIC_CACHE_MAX_AGE
+    if file.expiration_date:
+        max_age = min(max_age, max(0, int(file.expiration_date - time())))
+    patch_cache_control(response, public=True, max_age=max_age)
+
+
+def throttled_response(error):
+    """Too many downloads of the link or from the client (429), or in
+    total (503)."""
+    metrics.throttled_downloads.inc(scope=error.scope)
+    status = 503 if error.scope == 'total' else 429
+    response = HttpResponse(
+        "Too many downloads, please try again later.",
+        content_type='text/plain', status=status)
+    response['Retry-After'] = error.retry_after
     return response
 
 
@@ -289,3 +724,73 @@ def set_content_disposition_header(response, filename):
     filename = quote(filename.encode('utf-8'))
     template = 'attachment; filename="{0}"; filename*=UTF-8\'\'{0};'
     response['Content-Disposition'] = template.format(filename)
+
+
+class InternalMixin(object):
+    """Restricts the view to `settings.INTERNAL_IPS`."""
+
+    def dispatch(self, request, *args, **kwargs):
+        if get_ip(request) not in settings.INTERNAL_IPS:
+            return HttpResponseForbidden()
+        return super(InternalMixin, self).dispatch(request, *args, **kwargs)
+
+
+class MetricsView(InternalMixin, generic.View):
+    """Metrics of all worker processes, in the Prometheus text format."""
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def get(self, *args, **kwargs):
+        if not settings.METRICS_ENABLED:
+            raise Http404()
+        return HttpResponse(metrics.render(), content_type=self.content_type)
+
+
+class LinkStatsView(InternalMixin, generic.View):
+    """Download counters of a link (`token`), or of the `top` links by
+    `order` (downloads, bytes or last_download)."""
+    orders = ('downloads', 'bytes', 'last_download')
+
+    def get(self, *args, **kwargs):
+        token = self.request.GET.get('token')
+        if token:
+            if core.get_shared_file_info(token) is None:
+                raise Http404()
+            return JsonResponse(self.link_json(token, stats.get(token)))
+
+        order = self.request.GET.get('order', 'downloads')
+        try:
+            count = int(self.request.GET.get('top', 10))
+            key = self.orders.index(order)
+        except ValueError:
+            return JsonResponse({'error': "Invalid top or order."},
+                                status=400)
+        links = [self.link_json(link, counters)
+                 for link, counters in stats.top(count, key)]
+        return JsonResponse({'links': links})
+
+    def link_json(self, token, counters):
+        data = {'token': token}
+        data.update(zip(self.orders, counters))
+        return data
+
+
+class HealthView(generic.View):
+    """Liveness check; doesn't touch the cluster."""
+
+    def get(self, *args, **kwargs):
+        return HttpResponse('OK', content_type='text/plain')
+
+
+class ReadyView(generic.View):
+    """Readiness check; fails until the worker is initialized, see
+    `core.warmup`."""
+
+    def get(self, *args, **kwargs):
+        try:
+            with timeout(seconds=5):
+                core.ensure_share_links_volume()
+        except (SXClientException, TimeoutError) as e:
+            logger.warning("Not ready: {}".format(e))
+            return HttpResponse('Not ready', content_type='text/plain',
+                                status=503)
+        return HttpResponse('OK', content_type='text/plain')
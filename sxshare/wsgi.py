@@ -19,3 +19,6 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sxshare.settings")
 
 application = get_wsgi_application()
+
+from sxshare.core import warmup  # NOQA
+warmup()
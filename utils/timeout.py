@@ -14,7 +14,12 @@ def timeout(seconds=9, error_message="Operation timed out."):
     def handle_timeout(signum, frame):
         raise TimeoutError(error_message)
 
-    signal.signal(signal.SIGALRM, handle_timeout)
+    previous = signal.signal(signal.SIGALRM, handle_timeout)
     signal.alarm(seconds)
-    yield
-    signal.alarm(0)
+    try:
+        yield
+    finally:
+        # Also when the block raises, or the alarm would fire later, in
+        # whatever the worker is doing then
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, previous)